@@ -0,0 +1,131 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+r"""Compares the TFRecord image encodings supported by build_tf_record_dataset.
+
+For each encoding, the same images are written to a local TFRecord file, then
+read back and decoded the way tpu_model.py does. Bytes on disk, and records/sec
+for writing and for reading are printed.
+
+Example usage:
+
+python benchmark_tf_record_encodings.py --src_bucket datathon-cbis-ddsm-colab \
+                                        --src_folder small_train \
+                                        --max_images 500
+"""
+
+import argparse
+from io import BytesIO
+import itertools
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+from PIL import Image
+import tensorflow as tf
+
+import build_tf_record_dataset
+import gcs_utils
+
+
+def load_images(bucket, folder, max_images):
+  """Downloads up to `max_images` images and their labels."""
+  images = []
+  for blob_name, label in itertools.islice(
+      build_tf_record_dataset.list_images(bucket, folder), max_images):
+    byte_stream = BytesIO()
+    bucket.blob(blob_name).download_to_file(byte_stream)
+    byte_stream.seek(0)
+    images.append((np.array(Image.open(byte_stream)), label))
+  return images
+
+
+def benchmark_write(images, encoding, path):
+  start = time.time()
+  with tf.python_io.TFRecordWriter(path) as w:
+    for image, label in images:
+      example = build_tf_record_dataset.make_example(image, label, encoding)
+      w.write(example.SerializeToString())
+  return len(images) / max(time.time() - start, 1e-6)
+
+
+def benchmark_read(path, encoding, count):
+
+  def parse(serialized_example):
+    features = tf.parse_single_example(
+        serialized_example,
+        features={
+            'label': tf.FixedLenFeature([], tf.int64),
+            'image': tf.FixedLenFeature([], tf.string),
+        })
+    return (build_tf_record_dataset.decode_image(features['image'], encoding),
+            features['label'])
+
+  with tf.Graph().as_default():
+    dataset = tf.data.TFRecordDataset(path).map(parse)
+    next_element = dataset.make_one_shot_iterator().get_next()
+    with tf.Session() as sess:
+      start = time.time()
+      try:
+        while True:
+          sess.run(next_element)
+      except tf.errors.OutOfRangeError:
+        pass
+      return count / max(time.time() - start, 1e-6)
+
+
+def run(args):
+  bucket = gcs_utils.get_bucket(args.src_bucket)
+  images = load_images(bucket, args.src_folder, args.max_images)
+
+  print('%-8s %14s %14s %14s' % ('encoding', 'bytes', 'write rec/s',
+                                 'read rec/s'))
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    for encoding in build_tf_record_dataset.ENCODINGS:
+      path = os.path.join(tmp_dir, '%s.tfrecords' % encoding)
+      try:
+        write_rate = benchmark_write(images, encoding, path)
+      except ValueError as e:
+        print('%-8s skipped: %s' % (encoding, e))
+        continue
+      read_rate = benchmark_read(path, encoding, len(images))
+      print('%-8s %14d %14.1f %14.1f' % (encoding, os.path.getsize(path),
+                                         write_rate, read_rate))
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark image encodings.')
+  parser.add_argument(
+      '--src_bucket',
+      type=str,
+      required=True,
+      help='A GCS bucket to read source images.')
+  parser.add_argument(
+      '--src_folder',
+      type=str,
+      required=True,
+      help='A folder within the GCS bucket to read source images.')
+  parser.add_argument(
+      '--max_images',
+      type=int,
+      default=500,
+      help='Number of images to benchmark with.')
+  args = parser.parse_args()
+
+  run(args)
@@ -20,72 +20,232 @@ Example usage:
 python build_tf_record_dataset.py --src_bucket datathon-cbis-ddsm-colab \
                                   --src_folder train \
                                   --dst_bucket datathon-cbis-ddsm-colab \
-                                  --dst_file cache/train.tfrecords
+                                  --dst_file cache/train.tfrecords \
+                                  --num_shards 8
+
+Records are written while images are still being downloaded, so memory usage
+does not grow with the size of the dataset. A manifest listing the shards and
+their record counts is written to <dst_file>.manifest.json.
 """
 
 import argparse
 from io import BytesIO
+import json
+from multiprocessing.pool import ThreadPool
+import threading
+import time
 import numpy as np
 from PIL import Image
 import tensorflow as tf
-from google.cloud import storage
 
-client = storage.Client()
+from cbis_ddsm_ml.trainer import image_encoding
+import gcs_utils
+
+# Supported encodings of the "image" feature, and how the models decode them.
+ENCODINGS = image_encoding.ENCODINGS
+decode_image = image_encoding.decode_image
 
 
-def load_data(bucket, folder):
-  """Loads images from a GCS bucket, and parses labels from filenames.
+def list_images(bucket, folder):
+  """Lists images in a GCS bucket, and parses labels from filenames.
 
   Args:
     bucket: A GCS bucket.
     folder: A subfolder inside the bucket.
 
-  Returns:
-    An array of images as numpy matrices, and an array of labels.
+  Yields:
+    Tuples of blob name and label.
   """
-  images = []
-  labels = []
   # 1, 2, 3 and 4 are breast density categories.
   for label in [1, 2, 3, 4]:
     blobs = bucket.list_blobs(prefix=('%s/%s_' % (folder, label)))
 
     for blob in blobs:
-      byte_stream = BytesIO()
-      blob.download_to_file(byte_stream)
-      byte_stream.seek(0)
+      yield blob.name, label - 1  # Minus 1 to fit in [0, 4) for evaluation.
+
+
+def encode_image(image, encoding):
+  """Encodes an image as the bytes stored in the "image" feature.
+
+  Args:
+    image: A 2-D numpy array.
+    encoding: One of ENCODINGS. "float32", "uint8" and "uint16" store the raw
+      pixels in that type, "png" stores a 16-bit PNG.
+
+  Returns:
+    The encoded image.
+
+  Raises:
+    ValueError: If the pixel values do not fit in the requested type.
+  """
+  dtype = np.uint16 if encoding == 'png' else np.dtype(encoding)
+  if np.issubdtype(dtype, np.integer) and image.size:
+    info = np.iinfo(dtype)
+    if image.min() < info.min or image.max() > info.max:
+      raise ValueError('Pixel values in [%s, %s] do not fit in %s' %
+                       (image.min(), image.max(), encoding))
+  image = image.astype(dtype)
+
+  if encoding == 'png':
+    byte_stream = BytesIO()
+    Image.fromarray(image).save(byte_stream, format='PNG')
+    return byte_stream.getvalue()
+  return image.tostring()
+
+
+def make_example(image, label, encoding):
+  """Returns a tf.Example holding an encoded image and its label."""
+  feature = {
+      'label':
+          tf.train.Feature(int64_list=tf.train.Int64List(value=[label])),
+      'image':
+          tf.train.Feature(
+              bytes_list=tf.train.BytesList(
+                  value=[tf.compat.as_bytes(encode_image(image, encoding))])),
+      'encoding':
+          tf.train.Feature(
+              bytes_list=tf.train.BytesList(
+                  value=[tf.compat.as_bytes(encoding)])),
+  }
+  return tf.train.Example(features=tf.train.Features(feature=feature))
+
+
+def load_example(bucket_name, blob_name, label, encoding='float32'):
+  """Downloads an image and converts it to a serialized tf.Example.
+
+  Args:
+    bucket_name: Name of the GCS bucket holding the image.
+    blob_name: Name of the image within the bucket.
+    label: Label of the image.
+    encoding: How to encode the image, one of ENCODINGS.
 
-      img = Image.open(byte_stream)
-      images.append(np.array(img, dtype=np.float32))
-      labels.append(label - 1)  # Minus 1 to fit in [0, 4) for evaluation.
+  Returns:
+    A tuple of the serialized tf.Example and the shape of the image.
+  """
+  byte_stream = BytesIO()
+  bucket = gcs_utils.get_bucket(bucket_name)
+  bucket.blob(blob_name).download_to_file(byte_stream)
+  byte_stream.seek(0)
+
+  image = np.array(Image.open(byte_stream))
+  example = make_example(image, label, encoding)
+  return example.SerializeToString(), image.shape
+
+
+def shard_paths(record_path, num_shards):
+  """Returns the paths of the TFRecord files to write."""
+  if num_shards == 1:
+    return [record_path]
+  return [
+      '%s-%05d-of-%05d' % (record_path, i, num_shards)
+      for i in range(num_shards)
+  ]
+
+
+def load_and_save_as_tf_records(src_bucket,
+                                src_folder,
+                                dst_bucket,
+                                dst_file,
+                                num_shards=1,
+                                concurrency=1,
+                                max_in_flight=None,
+                                encoding='float32'):
+  """Converts images and labels to TFRecords.
+
+  Images are downloaded by `concurrency` threads and written as soon as they
+  arrive, round-robin across `num_shards` TFRecord files. At most
+  `max_in_flight` images are held in memory at any time, regardless of the
+  size of the dataset. Images are stored with the given `encoding`, see
+  `encode_image`. A JSON manifest describing the shards is written next
+  to them, at `dst_file` + ".manifest.json".
+
+  Returns:
+    The manifest, as a dict.
+  """
+  if max_in_flight is None:
+    max_in_flight = 2 * concurrency
 
-  return images, labels
+  # Bounds the number of images which are downloaded but not written yet. The
+  # pool pulls names from `_throttled` in its own thread, which blocks here
+  # until the main thread has written enough records.
+  slots = threading.Semaphore(max_in_flight)
+  # Set on shutdown, so that `_throttled` stops instead of starting more
+  # downloads when its slots are released.
+  stopping = threading.Event()
 
+  def _throttled(images):
+    for image in images:
+      slots.acquire()
+      if stopping.is_set():
+        return
+      yield image
 
-def load_and_save_as_tf_records(src_bucket, src_folder, dst_bucket, dst_file):
-  """Converts images and labels to TFRecords."""
-  images, labels = load_data(src_bucket, src_folder)
+  def _load(image):
+    blob_name, label = image
+    return load_example(src_bucket.name, blob_name, label,
+                        encoding) + (label,)
 
   record_path = 'gs://%s/%s' % (dst_bucket.name, dst_file)
-  with tf.python_io.TFRecordWriter(record_path) as w:
-    for i, image in enumerate(images):
-      feature = {
-          'label':
-              tf.train.Feature(
-                  int64_list=tf.train.Int64List(value=[labels[i]])),
-          'image':
-              tf.train.Feature(
-                  bytes_list=tf.train.BytesList(
-                      value=[tf.compat.as_bytes(image.tostring())])),
-      }
-      example = tf.train.Example(features=tf.train.Features(feature=feature))
-      w.write(example.SerializeToString())
+  paths = shard_paths(record_path, num_shards)
+  writers = [tf.python_io.TFRecordWriter(path) for path in paths]
+  record_counts = [0] * num_shards
+  label_counts = {}
+  image_shape = None
+
+  start = time.time()
+  pool = ThreadPool(concurrency)
+  try:
+    results = pool.imap_unordered(
+        _load, _throttled(list_images(src_bucket, src_folder)))
+    for i, (example, shape, label) in enumerate(results):
+      writers[i % num_shards].write(example)
+      slots.release()
+      record_counts[i % num_shards] += 1
+      label_counts[label] = label_counts.get(label, 0) + 1
+      image_shape = image_shape or list(shape)
+  finally:
+    # Unblock `_throttled` in case we stopped before consuming all results.
+    # pool.terminate() waits for the thread running `_throttled`, so it must
+    # be released first, after marking that no more images should be loaded.
+    stopping.set()
+    for _ in range(max_in_flight):
+      slots.release()
+    pool.terminate()
+    pool.join()
+    for w in writers:
+      w.close()
+
+  total = sum(record_counts)
+  elapsed = time.time() - start
+  print('Wrote %d records to %d files in %.1fs (%.2f records/sec)' %
+        (total, num_shards, elapsed, total / max(elapsed, 1e-6)))
+
+  manifest = {
+      'shards': [{
+          'path': path,
+          'records': count
+      } for path, count in zip(paths, record_counts)],
+      'records': total,
+      'label_counts': {str(k): v for k, v in sorted(label_counts.items())},
+      'image_shape': image_shape,
+      'encoding': encoding,
+  }
+  with tf.gfile.GFile(record_path + '.manifest.json', 'w') as f:
+    f.write(json.dumps(manifest, indent=2, sort_keys=True))
+  return manifest
 
 
 def run(args):
-  src_bucket = client.get_bucket(args.src_bucket)
-  dst_bucket = client.get_bucket(args.dst_bucket)
-  load_and_save_as_tf_records(src_bucket, args.src_folder, dst_bucket,
-                              args.dst_file)
+  src_bucket = gcs_utils.get_bucket(args.src_bucket)
+  dst_bucket = gcs_utils.get_bucket(args.dst_bucket)
+  load_and_save_as_tf_records(
+      src_bucket,
+      args.src_folder,
+      dst_bucket,
+      args.dst_file,
+      num_shards=args.num_shards,
+      concurrency=args.concurrency,
+      encoding=args.encoding)
 
 
 if __name__ == '__main__':
@@ -110,6 +270,24 @@ if __name__ == '__main__':
       type=str,
       required=True,
       help='A file within the GCS bucket to write TFRecords.')
+  parser.add_argument(
+      '--num_shards',
+      type=int,
+      default=1,
+      help='Number of TFRecord files to spread the records across. Shards are '
+      'named <dst_file>-<index>-of-<num_shards> if this is larger than 1.')
+  parser.add_argument(
+      '--concurrency',
+      type=int,
+      default=16,
+      help='Number of images to download in parallel.')
+  parser.add_argument(
+      '--encoding',
+      type=str,
+      default='float32',
+      choices=ENCODINGS,
+      help='How to store the pixels: raw float32, uint8 or uint16 values, or '
+      'a 16-bit PNG. Pass the same value as --image_encoding when training.')
   args = parser.parse_args()
 
   run(args)
@@ -19,6 +19,12 @@ This model is basically the same as what we have in the "2018 NUS-MIT Datathon
 Tutorial: Machine Learning on CBIS-DDSM" tutorial (you can find it at
 https://git.io/vhgOu). For detailed explanation on how the model works, please
 go to https://www.tensorflow.org/tutorials/layers.
+
+Input data is either read from TFRecords generated by build_tf_record_dataset.py
+(--training_data and --eval_data) through a tf.data pipeline, or downloaded
+image by image into memory (--data_bucket, --training_data_dir and
+--eval_data_dir). The former starts training immediately and is not bounded by
+the memory of the host.
 """
 
 from io import BytesIO
@@ -27,6 +33,8 @@ from PIL import Image
 import tensorflow as tf
 from google.cloud import storage
 
+import image_encoding
+
 # Input data specific flags.
 tf.flags.DEFINE_string(
     "data_bucket", default=None, help="The bucket where input data is stored.")
@@ -38,6 +46,45 @@ tf.flags.DEFINE_string(
     "eval_data_dir",
     default=None,
     help="Path to evaluation data within the data bucket.")
+tf.flags.DEFINE_string(
+    "training_data",
+    default=None,
+    help="Path or glob pattern of training TFRecords, e.g. "
+    "gs://datathon-cbis-ddsm-colab/cache/ddsm_train.tfrecords*. Takes "
+    "precedence over --data_bucket and --training_data_dir.")
+tf.flags.DEFINE_string(
+    "eval_data",
+    default=None,
+    help="Path or glob pattern of evaluation TFRecords, e.g. "
+    "gs://datathon-cbis-ddsm-colab/cache/ddsm_eval.tfrecords*. Required with "
+    "--training_data.")
+tf.flags.DEFINE_enum(
+    "image_encoding",
+    default="float32",
+    enum_values=list(image_encoding.ENCODINGS),
+    help="[Optional] How images are encoded in the TFRecords. This should "
+    "match the --encoding used by build_tf_record_dataset.py.")
+tf.flags.DEFINE_boolean(
+    "cache_data",
+    default=False,
+    help="[Optional] Cache parsed TFRecords in memory after the first epoch. "
+    "Only use this if the dataset fits in memory.")
+tf.flags.DEFINE_integer(
+    "shuffle_buffer_size",
+    default=1000,
+    help="[Optional] Number of examples to shuffle training data across.")
+tf.flags.DEFINE_integer(
+    "num_parallel_reads",
+    default=4,
+    help="[Optional] Number of TFRecord files to read in parallel.")
+tf.flags.DEFINE_integer(
+    "num_parallel_calls",
+    default=4,
+    help="[Optional] Number of examples to parse in parallel.")
+tf.flags.DEFINE_integer(
+    "prefetch_batches",
+    default=2,
+    help="[Optional] Number of batches to prepare ahead of training.")
 tf.flags.DEFINE_integer("image_width", default=0, help="Wdith of input images.")
 tf.flags.DEFINE_integer(
     "image_height", default=0, help="Height of input images.")
@@ -174,12 +221,74 @@ def cnn_model_fn(features, labels, mode):
       mode=mode, loss=loss, eval_metric_ops=eval_metric_ops)
 
 
-def main(_):
-  # Load training and test data.
+def get_input_fn(file_pattern, training):
+  """Returns an `input_fn` reading TFRecords matching `file_pattern`.
+
+  Files are read in parallel and examples are parsed in parallel and
+  prefetched, so the input pipeline overlaps with training. Training data is
+  shuffled and repeated indefinitely, evaluation data is read once.
+  """
+
+  def parse(serialized_example):
+    """Parses a single tf.Example into image and label tensors."""
+    features = tf.parse_single_example(
+        serialized_example,
+        features={
+            "label": tf.FixedLenFeature([], tf.int64),
+            "image": tf.FixedLenFeature([], tf.string),
+        })
+    image = image_encoding.decode_image(features["image"],
+                                        FLAGS.image_encoding)
+    image = tf.reshape(image, [FLAGS.image_height, FLAGS.image_width])
+    label = tf.cast(features["label"], tf.int32)
+    return {"image": image}, label
+
+  def input_fn():
+    files = tf.data.Dataset.list_files(file_pattern, shuffle=training)
+    dataset = files.apply(
+        tf.contrib.data.parallel_interleave(
+            tf.data.TFRecordDataset,
+            cycle_length=FLAGS.num_parallel_reads,
+            sloppy=training))
+    dataset = dataset.map(parse, num_parallel_calls=FLAGS.num_parallel_calls)
+    if FLAGS.cache_data:
+      dataset = dataset.cache()
+    if training:
+      dataset = dataset.shuffle(FLAGS.shuffle_buffer_size).repeat()
+    dataset = dataset.batch(FLAGS.batch_size).prefetch(FLAGS.prefetch_batches)
+    return dataset.make_one_shot_iterator().get_next()
+
+  return input_fn
+
+
+def get_numpy_input_fns():
+  """Returns training and evaluation `input_fn`s over images held in memory."""
   image_loader = ImageLoader()
   train_data, train_labels = image_loader.load_train_images()
   eval_data, eval_labels = image_loader.load_test_images()
 
+  train_input_fn = tf.estimator.inputs.numpy_input_fn(
+      x={"image": train_data},
+      y=train_labels,
+      batch_size=FLAGS.batch_size,
+      num_epochs=None,
+      shuffle=True)
+  eval_input_fn = tf.estimator.inputs.numpy_input_fn(
+      x={"image": eval_data}, y=eval_labels, num_epochs=1, shuffle=False)
+  return train_input_fn, eval_input_fn
+
+
+def main(_):
+  if bool(FLAGS.training_data) != bool(FLAGS.eval_data):
+    raise ValueError("--training_data and --eval_data must be set together.")
+
+  # Set up training and test data.
+  if FLAGS.training_data:
+    train_input_fn = get_input_fn(FLAGS.training_data, training=True)
+    eval_input_fn = get_input_fn(FLAGS.eval_data, training=False)
+  else:
+    train_input_fn, eval_input_fn = get_numpy_input_fns()
+
   # Create the Estimator.
   classifier = tf.estimator.Estimator(
       model_fn=cnn_model_fn, model_dir=FLAGS.model_dir)
@@ -191,18 +300,10 @@ def main(_):
       tensors=tensors_to_log, every_n_iter=50)
 
   # Train the model.
-  train_input_fn = tf.estimator.inputs.numpy_input_fn(
-      x={"image": train_data},
-      y=train_labels,
-      batch_size=FLAGS.batch_size,
-      num_epochs=None,
-      shuffle=True)
   classifier.train(
       input_fn=train_input_fn, steps=FLAGS.training_steps, hooks=[logging_hook])
 
   # Evaluate the model and print results.
-  eval_input_fn = tf.estimator.inputs.numpy_input_fn(
-      x={"image": eval_data}, y=eval_labels, num_epochs=1, shuffle=False)
   eval_results = classifier.evaluate(
       input_fn=eval_input_fn, steps=FLAGS.eval_steps)
   print eval_results
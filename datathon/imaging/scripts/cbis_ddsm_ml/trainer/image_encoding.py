@@ -0,0 +1,36 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Encodings of the "image" feature of the TFRecords.
+
+The images are encoded by build_tf_record_dataset.py, and decoded by the
+models. This module lives in the trainer package, so that it is shipped to
+Cloud ML Engine with the models.
+"""
+
+import tensorflow as tf
+
+# Supported encodings of the "image" feature. "float32" is the original format
+# and is 2-4x larger than the others.
+ENCODINGS = ("float32", "uint8", "uint16", "png")
+
+
+def decode_image(encoded, encoding):
+  """Decodes an image stored with the given encoding into a float32 tensor."""
+  if encoding == "png":
+    image = tf.image.decode_png(encoded, dtype=tf.uint16)
+  else:
+    image = tf.decode_raw(encoded, tf.as_dtype(encoding))
+  return tf.cast(image, tf.float32)
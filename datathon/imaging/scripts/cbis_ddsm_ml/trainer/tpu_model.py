@@ -32,8 +32,11 @@ Please check out the tutorials folder (https://git.io/vhgaw) for instructions
 on training this model with TPU.
 """
 
+import time
 import tensorflow as tf
 
+import image_encoding
+
 # Cloud TPU Cluster Resolver flags.
 tf.flags.DEFINE_string(
     "tpu",
@@ -55,12 +58,13 @@ tf.flags.DEFINE_string(
 tf.flags.DEFINE_string(
     "training_data",
     default=None,
-    help="Path to training data. This should be a GCS path, "
-    "e.g. gs://datathon-cbis-ddsm-colab/cache/ddsm_train.tfrecords")
+    help="Path to training data. This should be a GCS path or glob pattern, "
+    "e.g. gs://datathon-cbis-ddsm-colab/cache/ddsm_train.tfrecords or "
+    "gs://datathon-cbis-ddsm-colab/cache/ddsm_train.tfrecords-*")
 tf.flags.DEFINE_string(
     "eval_data",
     default=None,
-    help="Path to evaluation data. This should be a GCS path, "
+    help="Path to evaluation data. This should be a GCS path or glob pattern, "
     "e.g. gs://datathon-cbis-ddsm-colab/cache/ddsm_eval.tfrecords")
 tf.flags.DEFINE_integer(
     "image_width",
@@ -76,6 +80,33 @@ tf.flags.DEFINE_integer(
     "image_channel",
     default=1,
     help="[Optional] Number of channels in input images.")
+tf.flags.DEFINE_enum(
+    "image_encoding",
+    default="float32",
+    enum_values=list(image_encoding.ENCODINGS),
+    help="[Optional] How images are encoded in the TFRecords. This should "
+    "match the --encoding used by build_tf_record_dataset.py.")
+tf.flags.DEFINE_integer(
+    "num_parallel_reads",
+    default=8,
+    help="[Optional] Number of TFRecord files to read in parallel.")
+tf.flags.DEFINE_integer(
+    "num_parallel_calls",
+    default=4,
+    help="[Optional] Number of batches to parse in parallel.")
+tf.flags.DEFINE_integer(
+    "prefetch_batches",
+    default=2,
+    help="[Optional] Number of batches to prepare ahead of the TPU.")
+tf.flags.DEFINE_boolean(
+    "cache_data",
+    default=True,
+    help="[Optional] Cache the input data in memory after the first epoch.")
+tf.flags.DEFINE_integer(
+    "input_benchmark_steps",
+    default=0,
+    help="[Optional] If set, only measure the throughput of reading this many "
+    "batches of --training_data on the local CPU, without training.")
 
 # Model specific flags.
 tf.flags.DEFINE_string("model_dir", default=None, help="Estimator model_dir.")
@@ -178,8 +209,40 @@ def cnn_model_fn(features, labels, mode, params):
       mode=mode, loss=loss, eval_metrics=(metric_fn, [labels, logits]))
 
 
-def get_input_fn(filename):
-  """Returns an `input_fn` for training and evaluation."""
+def parse_batch(serialized_examples, batch_size):
+  """Parses a batch of serialized tf.Examples into image and label tensors.
+
+  The tensors have fully defined shapes, as required by the TPU infeed.
+  """
+  features = tf.parse_example(
+      serialized_examples,
+      features={
+          "label": tf.FixedLenFeature([], tf.int64),
+          "image": tf.FixedLenFeature([], tf.string),
+      })
+  if FLAGS.image_encoding == "png":
+    # PNGs can only be decoded one at a time.
+    images = tf.map_fn(
+        lambda encoded: image_encoding.decode_image(encoded, "png"),
+        features["image"],
+        dtype=tf.float32)
+  else:
+    images = image_encoding.decode_image(features["image"],
+                                         FLAGS.image_encoding)
+  images = tf.reshape(images,
+                      [batch_size, FLAGS.image_height, FLAGS.image_width])
+  labels = tf.cast(features["label"], tf.int32)
+  labels.set_shape([batch_size])
+  return images, labels
+
+
+def get_input_fn(file_pattern):
+  """Returns an `input_fn` for training and evaluation.
+
+  `file_pattern` may be a single TFRecord file or a glob matching the shards
+  written by build_tf_record_dataset.py. Shards are read in parallel, examples
+  are parsed a batch at a time and batches are prefetched.
+  """
 
   def input_fn(params):
     # Retrieves the batch size for the current shard. The number of shards is
@@ -188,30 +251,54 @@ def get_input_fn(filename):
     # for details.
     batch_size = params["batch_size"]
 
-    def parse(serialized_example):
-      """Parses a single tf.Example into image and label tensors."""
-      features = tf.parse_single_example(
-          serialized_example,
-          features={
-              "label": tf.FixedLenFeature([], tf.int64),
-              "image": tf.FixedLenFeature([], tf.string),
-          })
-      image = tf.decode_raw(features["image"], tf.float32)
-      image = tf.reshape(image, [FLAGS.image_width, FLAGS.image_height])
-      label = tf.cast(features["label"], tf.int32)
-      return image, label
-
-    dataset = tf.data.TFRecordDataset(filename, buffer_size=500000)
-    dataset = dataset.map(parse).cache().repeat()
+    files = tf.data.Dataset.list_files(file_pattern, shuffle=False)
+    dataset = files.apply(
+        tf.contrib.data.parallel_interleave(
+            lambda f: tf.data.TFRecordDataset(f, buffer_size=500000),
+            cycle_length=FLAGS.num_parallel_reads))
+    if FLAGS.cache_data:
+      dataset = dataset.cache()
+    dataset = dataset.repeat()
     dataset = dataset.batch(batch_size, drop_remainder=True)
+    dataset = dataset.map(
+        lambda examples: parse_batch(examples, batch_size),
+        num_parallel_calls=FLAGS.num_parallel_calls)
+    dataset = dataset.prefetch(FLAGS.prefetch_batches)
     images, labels = dataset.make_one_shot_iterator().get_next()
     return images, labels
 
   return input_fn
 
 
+def benchmark_input_fn(file_pattern, steps):
+  """Measures the throughput of the input pipeline on the local CPU."""
+  with tf.Graph().as_default():
+    images, labels = get_input_fn(file_pattern)({
+        "batch_size": FLAGS.batch_size
+    })
+    # The TPU infeed rejects tensors whose shapes are not fully defined.
+    for tensor in (images, labels):
+      if not tensor.shape.is_fully_defined():
+        raise ValueError("Input tensor %s has a partially defined shape: %s" %
+                         (tensor.name, tensor.shape))
+    with tf.Session() as sess:
+      # Warm up, e.g. open the files and fill the prefetch buffer.
+      sess.run([images, labels])
+      start = time.time()
+      for _ in range(steps):
+        sess.run([images, labels])
+      elapsed = time.time() - start
+  tf.logging.info("Read %d batches of %d examples in %.1fs (%.1f examples/sec)",
+                  steps, FLAGS.batch_size, elapsed,
+                  steps * FLAGS.batch_size / elapsed)
+
+
 def main(_):
   """Set up training and evaluation steps."""
+  if FLAGS.input_benchmark_steps:
+    benchmark_input_fn(FLAGS.training_data, FLAGS.input_benchmark_steps)
+    return
+
   tpu_cluster_resolver = tf.contrib.cluster_resolver.TPUClusterResolver(
       FLAGS.tpu, zone=FLAGS.tpu_zone, project=FLAGS.gcp_project)
   run_config = tf.contrib.tpu.RunConfig(
@@ -0,0 +1,32 @@
+#!/usr/bin/python
+#
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""GCS helpers shared by the scripts that access buckets from many threads."""
+
+import threading
+from google.cloud import storage
+
+# Storage clients are not thread-safe, so each thread gets its own.
+_thread_local = threading.local()
+
+
+def get_bucket(name):
+  """Returns a bucket bound to a storage client owned by the current thread."""
+  if not hasattr(_thread_local, 'client'):
+    _thread_local.client = storage.Client()
+    _thread_local.buckets = {}
+  if name not in _thread_local.buckets:
+    _thread_local.buckets[name] = _thread_local.client.bucket(name)
+  return _thread_local.buckets[name]
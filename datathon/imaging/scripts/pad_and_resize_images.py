@@ -25,39 +25,126 @@ python pad_and_resize_images.py --target_width 5251 \
                                 --dst_bucket datathon-cbis-ddsm-colab \
                                 --dst_folder small_train \
                                 --src_folder train
+
+Add `--concurrency 32 --skip_existing` to process many images in parallel and
+to resume an interrupted run.
 """
 
 import argparse
 from io import BytesIO
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import time
 import numpy as np
 from PIL import Image
 from google.cloud import storage
 
+import gcs_utils
+
 client = storage.Client()
 
 
-def pad_and_resize_image(src_bucket, dst_bucket, blob, args):
-  byte_stream = BytesIO()
-  blob.download_to_file(byte_stream)
-  byte_stream.seek(0)
+def _dst_name(blob_name, args):
+  return '%s/%s' % (args.dst_folder, blob_name.split('/', 1)[1])
 
+
+def _pad_and_resize(data, target_width, target_height, final_width,
+                    final_height):
+  """Pads and resizes an encoded image.
+
+  Args:
+    data: bytes of the source image.
+    target_width: width to pad the image to.
+    target_height: height to pad the image to.
+    final_width: width to resize the padded image to.
+    final_height: height to resize the padded image to.
+
+  Returns:
+    The resized image encoded as PNG bytes.
+  """
   # Pad images by adding black pixels to right and bottom.
-  img = np.array(Image.open(byte_stream))
-  mask = np.full((args.target_height, args.target_width), 0)
+  img = np.array(Image.open(BytesIO(data)))
+  mask = np.full((target_height, target_width), 0)
   mask[:img.shape[0], :img.shape[1]] = img
 
   # Resize images to the desired size.
   upload_byte_stream = BytesIO()
   # We have to use uint32 instead of uint16.
-  (Image.fromarray(mask.astype('uint32')).resize((args.final_width,
-                                                  args.final_height)).save(
+  (Image.fromarray(mask.astype('uint32')).resize((final_width,
+                                                  final_height)).save(
                                                       upload_byte_stream,
                                                       format='PNG'))
+  return upload_byte_stream.getvalue()
+
+
+def pad_and_resize_image(src_bucket, dst_bucket, blob, args):
+  byte_stream = BytesIO()
+  blob.download_to_file(byte_stream)
+
+  data = _pad_and_resize(byte_stream.getvalue(), args.target_width,
+                         args.target_height, args.final_width,
+                         args.final_height)
+
+  blob = dst_bucket.blob(_dst_name(blob.name, args))
+  blob.upload_from_file(BytesIO(data))
+
+
+class ProgressReporter(object):
+  """Periodically prints the number of processed images and the throughput."""
 
-  blob = dst_bucket.blob(
-      ('%s/%s' % (args.dst_folder, blob.name.split('/', 1)[1])))
-  upload_byte_stream.seek(0)
-  blob.upload_from_file(upload_byte_stream)
+  def __init__(self, report_every):
+    self._report_every = report_every
+    self._start = time.time()
+    self._count = 0
+
+  def update(self):
+    self._count += 1
+    if self._report_every and self._count % self._report_every == 0:
+      self.report()
+
+  def report(self):
+    elapsed = time.time() - self._start
+    print('Processed %d images in %.1fs (%.2f images/sec)' %
+          (self._count, elapsed, self._count / max(elapsed, 1e-6)))
+
+
+def list_existing(dst_bucket, args):
+  """Returns the names of the images already written to the destination."""
+  blobs = dst_bucket.list_blobs(prefix=('%s/' % args.dst_folder))
+  return set(blob.name for blob in blobs)
+
+
+def _run_concurrently(names, args, progress):
+  """Pads and resizes images concurrently.
+
+  GCS I/O is done by a thread pool while the pixel work is done by a process
+  pool. Each I/O thread downloads an image, hands the bytes to the process pool
+  for padding and resizing, and uploads the result, so up to
+  `args.concurrency` images are in flight at any time.
+  """
+  # Fork the workers before any I/O thread is started.
+  process_pool = multiprocessing.Pool(args.processes)
+  thread_pool = ThreadPool(args.concurrency)
+
+  def _process(name):
+    byte_stream = BytesIO()
+    src_bucket = gcs_utils.get_bucket(args.src_bucket)
+    src_bucket.blob(name).download_to_file(byte_stream)
+    data = process_pool.apply(
+        _pad_and_resize,
+        (byte_stream.getvalue(), args.target_width, args.target_height,
+         args.final_width, args.final_height))
+    dst_bucket = gcs_utils.get_bucket(args.dst_bucket)
+    dst_bucket.blob(_dst_name(name, args)).upload_from_file(BytesIO(data))
+
+  try:
+    for _ in thread_pool.imap_unordered(_process, names):
+      progress.update()
+  finally:
+    thread_pool.terminate()
+    process_pool.terminate()
+    thread_pool.join()
+    process_pool.join()
 
 
 def run(args):
@@ -65,9 +152,22 @@ def run(args):
   blobs = src_bucket.list_blobs(prefix=('%s/' % args.src_folder))
 
   dst_bucket = client.get_bucket(args.dst_bucket)
-  for blob in blobs:
-    if not blob.name.endswith('/'):
+  existing = list_existing(dst_bucket, args) if args.skip_existing else set()
+
+  progress = ProgressReporter(args.report_every)
+  if args.concurrency > 1:
+    names = (blob.name
+             for blob in blobs
+             if not blob.name.endswith('/') and
+             _dst_name(blob.name, args) not in existing)
+    _run_concurrently(names, args, progress)
+  else:
+    for blob in blobs:
+      if blob.name.endswith('/') or _dst_name(blob.name, args) in existing:
+        continue
       pad_and_resize_image(src_bucket, dst_bucket, blob, args)
+      progress.update()
+  progress.report()
 
 
 if __name__ == '__main__':
@@ -112,6 +212,28 @@ if __name__ == '__main__':
       type=str,
       required=True,
       help='GCS folder to save images to.')
+  parser.add_argument(
+      '--concurrency',
+      type=int,
+      default=1,
+      help='Number of images downloaded, processed and uploaded in parallel. '
+      'Images are processed one by one if this is 1.')
+  parser.add_argument(
+      '--processes',
+      type=int,
+      default=multiprocessing.cpu_count(),
+      help='Number of processes used to pad and resize images when '
+      '--concurrency is larger than 1.')
+  parser.add_argument(
+      '--skip_existing',
+      action='store_true',
+      help='Skip images which already exist in the destination folder, so '
+      'that an interrupted run can be resumed.')
+  parser.add_argument(
+      '--report_every',
+      type=int,
+      default=100,
+      help='Print progress every this many images.')
   args = parser.parse_args()
 
   run(args)
@@ -37,13 +37,59 @@ python select_demo_images.py --src_bucket=datathon-cbis-ddsm-colab \
 """
 
 import argparse
+from multiprocessing.pool import ThreadPool
 import random
 from google.cloud import storage
 
+import gcs_utils
+
 client = storage.Client()
 
 
+def reservoir_sample(iterable, k, rng):
+  """Selects k items uniformly at random from an iterable of unknown length.
+
+  Only k items are held in memory at any time.
+
+  Args:
+    iterable: The items to select from.
+    k: Number of items to select.
+    rng: A random.Random instance.
+
+  Returns:
+    A list of at most k items.
+  """
+  sample = []
+  for i, item in enumerate(iterable):
+    if i < k:
+      sample.append(item)
+    else:
+      j = rng.randint(0, i)
+      if j < k:
+        sample[j] = item
+  return sample
+
+
+def copy_blobs(src_bucket, dst_bucket, names, dst_folder, concurrency):
+  """Copies blobs server-side into `dst_folder`, `concurrency` at a time."""
+
+  def _copy(name):
+    src = gcs_utils.get_bucket(src_bucket.name)
+    src.copy_blob(
+        src.blob(name),
+        gcs_utils.get_bucket(dst_bucket.name),
+        new_name=('%s/%s' % (dst_folder, name.split('/')[1])))
+
+  pool = ThreadPool(concurrency)
+  try:
+    pool.map(_copy, names)
+  finally:
+    pool.terminate()
+    pool.join()
+
+
 def select_training_data(src_bucket, dst_bucket, args):
+  names = []
   # 1, 2, 3 and 4 are breast density categories.
   for i in [1, 2, 3, 4]:
     blobs = src_bucket.list_blobs(
@@ -52,35 +98,27 @@ def select_training_data(src_bucket, dst_bucket, args):
     c = 0
     for blob in blobs:
       if blob.name.endswith('_CC'):
-        src_bucket.copy_blob(
-            blob,
-            dst_bucket,
-            new_name=(
-                '%s/%s' % (args.dst_training_folder, blob.name.split('/')[1])))
+        names.append(blob.name)
 
         c += 1
         # Select the images for each category.
         if c == args.training_size_per_cat:
           break
 
+  copy_blobs(src_bucket, dst_bucket, names, args.dst_training_folder,
+             args.concurrency)
+
 
 def select_test_data(src_bucket, dst_bucket, args):
   blobs = src_bucket.list_blobs(prefix=(args.src_eval_folder))
 
-  objects = []
-  for blob in blobs:
-    if blob.name.endswith('_CC'):
-      objects.append(blob)
-
-  random.shuffle(objects)
+  # Select random test images while streaming through the listing.
+  names = reservoir_sample(
+      (blob.name for blob in blobs if blob.name.endswith('_CC')),
+      args.eval_size, random.Random(args.seed))
 
-  # Select random test images.
-  for i in range(args.eval_size):
-    src_bucket.copy_blob(
-        objects[i],
-        dst_bucket,
-        new_name=(
-            '%s/%s' % (args.dst_eval_folder, objects[i].name.split('/')[1])))
+  copy_blobs(src_bucket, dst_bucket, names, args.dst_eval_folder,
+             args.concurrency)
 
 
 def run(args):
@@ -133,6 +171,17 @@ if __name__ == '__main__':
       type=int,
       required=True,
       help='Number of images to select for evaluation.')
+  parser.add_argument(
+      '--seed',
+      type=int,
+      default=None,
+      help='Seed for selecting evaluation images, to make the selection '
+      'reproducible.')
+  parser.add_argument(
+      '--concurrency',
+      type=int,
+      default=16,
+      help='Number of images to copy in parallel.')
   args = parser.parse_args()
 
   run(args)
@@ -0,0 +1,229 @@
+# Copyright 2018 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmarks the STOW-RS batching of store_tcia_in_hc_api.py.
+
+Instances of random bytes are uploaded to a local fake DICOMweb server, which
+adds a fixed latency to every request to stand in for the authentication, TLS
+and network overhead of the Cloud Healthcare API. The server also fails to
+store some instances on their first upload, answering with a 202 partial
+failure, so that the retry of failed instances is part of the benchmark. The
+same instances are uploaded once per batch size, and the throughput
+(instances/sec) of each run is logged. A batch size of 0 uploads the instances
+one by one.
+
+Example usage:
+
+python -m scripts.benchmark_stow_rs_batching \
+    --num_instances 200 --instance_bytes 1048576 \
+    --max_batch_bytes 0,4194304,16777216
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import BaseHTTPServer
+import json
+import logging
+import os
+import random
+import shutil
+import SocketServer
+import sys
+import tempfile
+import threading
+import time
+import scripts.inference.dicomweb as dicomweb
+import scripts.store_tcia_in_hc_api as store_tcia_in_hc_api
+
+
+class _FakeDicomWebServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+  """Accepts STOW-RS requests, and counts the stored instances.
+
+  Each instance fails to be stored on its first upload with probability
+  failure_rate. Instances are expected to start with their SOP Instance UID,
+  followed by a null byte.
+  """
+  daemon_threads = True
+
+  def __init__(self, request_latency, failure_rate):
+    BaseHTTPServer.HTTPServer.__init__(self, ("localhost", 0),
+                                       _FakeDicomWebHandler)
+    self.request_latency = request_latency
+    self.failure_rate = failure_rate
+    self.num_requests = 0
+    self.num_instances = 0
+    self.num_failures = 0
+    # SOP Instance UIDs of the instances uploaded at least once.
+    self.uploaded = set()
+    self.lock = threading.Lock()
+
+
+class _FakeDicomWebHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  # Keep connections alive, as the Cloud Healthcare API does.
+  protocol_version = "HTTP/1.1"
+
+  def do_POST(self):  # pylint: disable=invalid-name
+    body = self.rfile.read(int(self.headers["content-length"]))
+    boundary = self.headers["content-type"].split('boundary="')[1].rstrip('"')
+    uids = [
+        part.split("\r\n\r\n", 1)[1].split("\0", 1)[0]
+        for part in body.split("--%s\r\n" % boundary)[1:]
+    ]
+    with self.server.lock:
+      failed = [
+          uid for uid in uids if uid not in self.server.uploaded and
+          random.random() < self.server.failure_rate
+      ]
+      self.server.uploaded.update(uids)
+      self.server.num_requests += 1
+      self.server.num_instances += len(uids) - len(failed)
+      self.server.num_failures += len(failed)
+    time.sleep(self.server.request_latency)
+    if failed:
+      content = json.dumps({
+          store_tcia_in_hc_api._FAILED_SOP_SEQUENCE_TAG: {  # pylint: disable=protected-access
+              "vr": "SQ",
+              "Value": [_FailedSOP(uid) for uid in failed]
+          }
+      })
+      self.send_response(202)
+    else:
+      content = "{}"
+      self.send_response(200)
+    self.send_header("content-type", "application/dicom+json")
+    self.send_header("content-length", str(len(content)))
+    self.end_headers()
+    self.wfile.write(content)
+
+  def log_message(self, *args):
+    pass
+
+
+def _FailedSOP(sop_instance_uid):
+  # type: (str) -> Dict[str, Any]
+  """Returns the Failed SOP Sequence item of an instance, in DICOM JSON."""
+  return {
+      store_tcia_in_hc_api._REFERENCED_SOP_INSTANCE_UID_TAG: {  # pylint: disable=protected-access
+          "vr": "UI",
+          "Value": [sop_instance_uid]
+      },
+      store_tcia_in_hc_api._FAILURE_REASON_TAG: {  # pylint: disable=protected-access
+          "vr": "US",
+          "Value": [0xC000]
+      }
+  }
+
+
+def _RunPipeline(server_url, instances, upload_concurrency, max_batch_bytes,
+                 max_attempts):
+  # type: (str, Dict[str, str], int, int, int) -> float
+  """Uploads the instances to the server, and returns the instances/sec."""
+  client = dicomweb.DicomWebClient()
+
+  def _Upload(batch):
+    return store_tcia_in_hc_api._UploadInstancesToHealthcareAPI(  # pylint: disable=protected-access
+        client, server_url, batch)
+
+  pipeline = store_tcia_in_hc_api._ImportPipeline(  # pylint: disable=protected-access
+      lambda uid: (uid, instances[uid]), _Upload, upload_concurrency,
+      upload_concurrency, len(instances), max_batch_bytes, max_attempts,
+      initial_backoff_secs=0.01)
+  progress = store_tcia_in_hc_api._Progress(len(instances), 0)  # pylint: disable=protected-access
+  manifest_dir = tempfile.mkdtemp()
+  manifest = store_tcia_in_hc_api._Manifest(  # pylint: disable=protected-access
+      os.path.join(manifest_dir, "manifest.jsonl"))
+  try:
+    start = time.time()
+    failures = pipeline.Run(sorted(instances), progress, manifest)
+    elapsed = time.time() - start
+    if failures:
+      logging.error("Failed to upload %d instances", len(failures))
+    return len(instances) / elapsed
+  finally:
+    manifest.Close()
+    shutil.rmtree(manifest_dir)
+
+
+def main(argv):
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      "--num_instances",
+      type=int,
+      default=200,
+      help="Number of instances to upload per run.")
+  parser.add_argument(
+      "--instance_bytes",
+      type=int,
+      default=2**20,
+      help="Size in bytes of each instance.")
+  parser.add_argument(
+      "--max_batch_bytes",
+      default="0,4194304,16777216",
+      help="Comma separated list of batch sizes in bytes to benchmark.")
+  parser.add_argument(
+      "--upload_concurrency",
+      type=int,
+      default=4,
+      help="Max concurrent uploads.")
+  parser.add_argument(
+      "--request_latency_ms",
+      type=int,
+      default=50,
+      help="Latency added by the fake server to every request.")
+  parser.add_argument(
+      "--failure_percentage",
+      type=int,
+      default=5,
+      help="Percentage of instances the fake server fails to store on their "
+      "first upload.")
+  parser.add_argument(
+      "--max_attempts",
+      type=int,
+      default=3,
+      help="Max number of attempts to upload each instance.")
+  args = parser.parse_args(argv)
+
+  server = _FakeDicomWebServer(args.request_latency_ms / 1000,
+                               args.failure_percentage / 100)
+  server_thread = threading.Thread(target=server.serve_forever)
+  server_thread.daemon = True
+  server_thread.start()
+  server_url = "http://localhost:%d/studies" % server.server_address[1]
+
+  inst = os.urandom(args.instance_bytes)
+  instances = {}
+  for i in range(args.num_instances):
+    uid = "1.2.3.%d" % i
+    instances[uid] = uid + "\0" + inst
+  for max_batch_bytes in [int(b) for b in args.max_batch_bytes.split(",")]:
+    with server.lock:
+      server.uploaded.clear()
+    num_requests = server.num_requests
+    num_failures = server.num_failures
+    instances_per_sec = _RunPipeline(server_url, instances,
+                                     args.upload_concurrency, max_batch_bytes,
+                                     args.max_attempts)
+    logging.info(
+        "Batch size %d bytes: %.2f instances/sec, %d requests, %d instances "
+        "retried", max_batch_bytes, instances_per_sec,
+        server.num_requests - num_requests, server.num_failures - num_failures)
+  server.shutdown()
+
+
+if __name__ == "__main__":
+  logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+  main(sys.argv[1:])
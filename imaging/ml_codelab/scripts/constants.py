@@ -17,3 +17,10 @@
 TRAINING_DATASET = 'training'
 VALIDATION_DATASET = 'validation'
 TESTING_DATASET = 'testing'
+
+# Prefix of TFRecords holding bottlenecks of all datasets, which are split into
+# training/validation/testing when read.
+UNSPLIT_DATASET = 'bottlenecks'
+
+# Number of float values in the Inception V3 bottleneck of an image.
+BOTTLENECK_SIZE = 2048
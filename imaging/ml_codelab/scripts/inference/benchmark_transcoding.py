@@ -0,0 +1,110 @@
+# Copyright 2018 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compares server-side and client-side transcoding of instances to JPEG.
+
+Each instance is retrieved in both --transcoding modes of inference.py, one
+after the other, and the latency of each mode is logged. If --model_path is
+set, the JPEG image is also sent to Cloud ML Engine for prediction, so that the
+latency covers everything inference.py does before storing the results.
+
+Example usage:
+
+python -m scripts.inference.benchmark_transcoding \
+    --instance_path projects/.../instances/<SOP_INSTANCE_UID> \
+    --instance_path projects/.../instances/<SOP_INSTANCE_UID> \
+    --num_repeats 3
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import functools
+import logging
+import multiprocessing
+import sys
+import time
+
+import scripts.inference.inference as inference
+
+
+def _Percentile(latencies, percentile):
+  # type: (List[float], int) -> float
+  latencies = sorted(latencies)
+  return latencies[min(len(latencies) - 1,
+                       int(len(latencies) * percentile / 100))]
+
+
+def main(argv):
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      '--instance_path',
+      action='append',
+      required=True,
+      help='Path of a DICOM instance to retrieve, as found in Pub/Sub '
+      'notifications. Can be repeated.')
+  parser.add_argument(
+      '--num_repeats',
+      type=int,
+      default=3,
+      help='Number of times each instance is retrieved in each mode.')
+  parser.add_argument(
+      '--image_size',
+      type=int,
+      default=299,
+      help='Width and height of the JPEG images transcoded locally.')
+  parser.add_argument(
+      '--model_path',
+      type=str,
+      default=None,
+      help='If set, path of the Cloud ML Engine model to also run prediction '
+      'with.')
+  args = parser.parse_args(argv)
+
+  transcode_pool = multiprocessing.Pool()
+  modes = {
+      'server': inference._WadoRS,  # pylint: disable=protected-access
+      'client': functools.partial(
+          inference._WadoRSAndTranscode,  # pylint: disable=protected-access
+          transcode_pool, args.image_size),
+  }
+  predictor = None
+  if args.model_path:
+    predictor = inference.CMLEPredictor(args.model_path, max_batch_size=1)
+
+  latencies = {mode: [] for mode in modes}
+  jpeg_bytes = {mode: 0 for mode in modes}
+  for _ in range(args.num_repeats):
+    for instance_path in args.instance_path:
+      for mode, fetch_image_fn in sorted(modes.items()):
+        start = time.time()
+        image_jpeg_bytes = fetch_image_fn(instance_path)
+        if predictor:
+          predictor.Predict(image_jpeg_bytes)
+        latencies[mode].append(time.time() - start)
+        jpeg_bytes[mode] += len(image_jpeg_bytes)
+
+  for mode in sorted(modes):
+    logging.info(
+        'Transcoding on %s: mean %.0fms, p50 %.0fms, max %.0fms, '
+        'mean JPEG size %d bytes', mode,
+        1000 * sum(latencies[mode]) / len(latencies[mode]),
+        1000 * _Percentile(latencies[mode], 50), 1000 * max(latencies[mode]),
+        jpeg_bytes[mode] // len(latencies[mode]))
+
+
+if __name__ == '__main__':
+  logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+  main(sys.argv[1:])
@@ -0,0 +1,256 @@
+# Copyright 2018 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Helpers for DICOMweb requests to the Cloud Healthcare API.
+
+This module has no dependency on the rest of the inference module, so that it
+can also be used by the other scripts of the codelab.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import httplib
+import os
+import Queue
+import random
+import socket
+import threading
+import time
+import urlparse
+import uuid
+
+import httplib2
+
+# Statuses of responses to requests that may succeed if retried.
+_RETRIABLE_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+
+def _RewindBody(body):
+  if hasattr(body, 'seek'):
+    body.seek(0)
+
+
+# httplib2 silently sends a request again if its keep-alive connection turns
+# out to be closed, without rewinding a file-like body, which would then be
+# sent truncated. These connections rewind the body every time it is sent.
+class _HTTPConnection(httplib2.HTTPConnectionWithTimeout):
+
+  def request(self, method, url, body=None, headers=None):
+    _RewindBody(body)
+    httplib2.HTTPConnectionWithTimeout.request(self, method, url, body,
+                                               headers or {})
+
+
+class _HTTPSConnection(httplib2.HTTPSConnectionWithTimeout):
+
+  def request(self, method, url, body=None, headers=None):
+    _RewindBody(body)
+    httplib2.HTTPSConnectionWithTimeout.request(self, method, url, body,
+                                                headers or {})
+
+
+_CONNECTION_TYPES = {'http': _HTTPConnection, 'https': _HTTPSConnection}
+
+
+class MultipartRelatedBody(object):
+  """Streaming multipart/related request body.
+
+  The body is a file-like object that httplib sends in blocks, so the request
+  is never assembled in memory. The delimiters of the parts are small strings,
+  and the parts themselves are read through memoryviews of their bytes, or from
+  the files they are stored in. The length of the body is known up front, so
+  httplib sets the Content-Length header from it.
+
+  Attributes:
+    boundary: Boundary delimiting the parts.
+    content_type: Value of the Content-Type header of the request.
+  """
+
+  def __init__(self, parts, part_content_type='application/dicom'):
+    """Creates the body.
+
+    Args:
+      parts: Content of each part, either a bytes-like object, or a seekable
+        file object that is read from its current position to its end.
+      part_content_type: Content type of the parts.
+    """
+    self.boundary = uuid.uuid4().hex
+    self.content_type = 'multipart/related; type="%s"; boundary="%s"' % (
+        part_content_type, self.boundary)
+    # (start offset in body, length, memoryview or (file, file offset)) tuples.
+    self._segments = []
+    self._length = 0
+    for part in parts:
+      self._AddBytes('--%s\r\nContent-Type: %s\r\n\r\n' % (self.boundary,
+                                                         part_content_type))
+      if hasattr(part, 'read'):
+        offset = part.tell()
+        self._AddSegment(os.fstat(part.fileno()).st_size - offset,
+                         (part, offset))
+      else:
+        self._AddBytes(part)
+      self._AddBytes('\r\n')
+    self._AddBytes('--%s--\r\n' % self.boundary)
+    self._position = 0
+
+  def _AddBytes(self, data):
+    self._AddSegment(len(data), memoryview(data))
+
+  def _AddSegment(self, length, source):
+    self._segments.append((self._length, length, source))
+    self._length += length
+
+  def __len__(self):
+    return self._length
+
+  def tell(self):
+    return self._position
+
+  def seek(self, offset, whence=os.SEEK_SET):
+    if whence == os.SEEK_CUR:
+      offset += self._position
+    elif whence == os.SEEK_END:
+      offset += self._length
+    self._position = min(max(offset, 0), self._length)
+
+  def read(self, size=-1):
+    """Reads up to size bytes, from a single segment unless size is negative."""
+    if size is None or size < 0:
+      chunks = []
+      while True:
+        chunk = self.read(1 << 20)
+        if not chunk:
+          return b''.join(chunks)
+        chunks.append(
+            chunk.tobytes() if isinstance(chunk, memoryview) else chunk)
+    for start, length, source in self._segments:
+      if start <= self._position < start + length:
+        offset = self._position - start
+        size = min(size, length - offset)
+        if isinstance(source, memoryview):
+          chunk = source[offset:offset + size]
+        else:
+          f, file_offset = source
+          f.seek(file_offset + offset)
+          chunk = f.read(size)
+        self._position += len(chunk)
+        return chunk
+    return b''
+
+
+class DicomWebClient(object):
+  """Thread-safe HTTP client for DICOMweb requests.
+
+  Requests are made with a pool of httplib2.Http objects, which keep their
+  connections alive, so that concurrent requests reuse connections instead of
+  opening new ones. The access token is shared by all requests, and refreshed
+  shortly before it expires, rather than by each request that fails with 401.
+  Requests that fail with a connection error, or a retriable status, are
+  retried with exponential backoff.
+
+  request() has the same signature as httplib2.Http.request, so the client can
+  be used in place of an httplib2.Http.
+  """
+
+  def __init__(self,
+               credentials=None,
+               timeout=60,
+               max_retries=3,
+               initial_backoff_secs=1.0,
+               refresh_margin_secs=300):
+    """Creates the client.
+
+    Args:
+      credentials: oauth2client credentials used to authorize requests. The
+        requests are not authorized if None.
+      timeout: Socket timeout of requests, in seconds.
+      max_retries: Max number of times a failed request is retried.
+      initial_backoff_secs: Delay before the first retry, doubled after each
+        retry.
+      refresh_margin_secs: The access token is refreshed when it expires in
+        less than this.
+    """
+    self._credentials = credentials
+    self._timeout = timeout
+    self._max_retries = max_retries
+    self._initial_backoff_secs = initial_backoff_secs
+    self._refresh_margin_secs = refresh_margin_secs
+    # Most recently used objects are reused first, their connections are the
+    # least likely to have been closed.
+    self._pool = Queue.LifoQueue()
+    self._token = None
+    self._token_expiry = 0
+    self._token_lock = threading.Lock()
+
+  def _GetAccessToken(self, force_refresh=False):
+    # type: bool -> str
+    with self._token_lock:
+      if (force_refresh or
+          time.time() > self._token_expiry - self._refresh_margin_secs):
+        self._credentials.refresh(httplib2.Http(timeout=self._timeout))
+        token_info = self._credentials.get_access_token()
+        self._token = token_info.access_token
+        if token_info.expires_in is None:
+          self._token_expiry = float('inf')
+        else:
+          self._token_expiry = time.time() + token_info.expires_in
+      return self._token
+
+  def request(self, uri, method='GET', body=None, headers=None):
+    """Makes a request, and returns its (response, content) tuple.
+
+    Args:
+      uri: URL of the request.
+      method: HTTP method of the request.
+      body: Body of the request, either a string or a seekable file object.
+      headers: Headers of the request.
+
+    Returns:
+      (response, content) tuple of the last attempt, as httplib2.Http.request.
+
+    Raises:
+      httplib2.HttpLib2Error, socket.error: If the last attempt failed to get
+        a response.
+    """
+    headers = dict(headers or {})
+    force_refresh = False
+    for attempt in range(self._max_retries + 1):
+      if attempt:
+        time.sleep(self._initial_backoff_secs * 2**(attempt - 1) *
+                   random.uniform(0.5, 1.5))
+      if self._credentials:
+        headers['authorization'] = 'Bearer %s' % self._GetAccessToken(
+            force_refresh)
+      try:
+        http = self._pool.get_nowait()
+      except Queue.Empty:
+        http = httplib2.Http(timeout=self._timeout)
+      try:
+        resp, content = http.request(
+            uri,
+            method=method,
+            body=body,
+            headers=headers,
+            connection_type=_CONNECTION_TYPES[urlparse.urlsplit(uri).scheme])
+      except (httplib2.HttpLib2Error, httplib.HTTPException, socket.error):
+        # The connection may be broken, do not reuse it.
+        if attempt == self._max_retries:
+          raise
+        continue
+      self._pool.put(http)
+      force_refresh = resp.status == 401 and self._credentials is not None
+      if not force_refresh and resp.status not in _RETRIABLE_STATUSES:
+        break
+    return resp, content
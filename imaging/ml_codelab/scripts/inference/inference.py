@@ -51,6 +51,17 @@ the customer. This script does the following actions:
    (3). This DICOM strucuted report will be stored back to the Cloud Healthcare
    API in the given DICOM store (--dicom_store_path). This instance
    can be then be retrieved by the client.
+
+Alternatively, if --bulk_dicom_store_path is set, the instances already in
+that DICOM store are listed with QIDO-RS and go through steps 2) to 4) as if a
+notification had been received for each of them, to backfill predictions. The
+instances processed are recorded in --bulk_checkpoint_path, so that an
+interrupted run can be resumed, and structured reports can be stored several
+per STOW-RS request (--sr_batch_size).
+
+Each of these steps is run by its own pool of worker threads (--*_workers
+flags), connected by bounded queues, so that multiple messages are processed
+concurrently. The latency of each step is logged every --stats_every messages.
 """
 
 from __future__ import absolute_import
@@ -60,21 +71,29 @@ from __future__ import print_function
 import abc
 import argparse
 import base64
-from email import encoders
-from email.mime import application
-from email.mime import multipart
+import bisect
+import collections
+import functools
+import hashlib
+import io
+import itertools
 import json
 import logging
-import mimetools
+import multiprocessing
 import os
+import Queue
 import re
 import sys
+import threading
+import time
 
 import googleapiclient.discovery
-import httplib2
+import numpy
 from oauth2client.client import GoogleCredentials
+from PIL import Image
 import pydicom
 from requests_toolbelt.multipart import decoder
+import scripts.inference.dicomweb as dicomweb
 
 from google.api_core.exceptions import InvalidArgument
 from google.api_core.exceptions import PermissionDenied
@@ -95,6 +114,9 @@ _HEALTHCARE_API_URL_PREFIX = 'https://healthcare.googleapis.com/v1alpha'
 _CREDENTIALS = GoogleCredentials.get_application_default().create_scoped(
     ['https://www.googleapis.com/auth/cloud-platform'])
 
+# Client used for all DICOMweb requests, replaced in main() to apply the flags.
+_DICOMWEB_CLIENT = dicomweb.DicomWebClient(_CREDENTIALS)
+
 # SOP Class UID for Basic Text Structured Reports.
 _BASIC_TEXT_SR_CUID = '1.2.840.10008.5.1.4.1.1.88.11'
 
@@ -104,6 +126,8 @@ _STRUCTURED_REPORT_ID = '1.2.840.10008.5.1.4.1.1.88.11'
 # DICOM Tags.
 _SOP_INSTANCE_UID_TAG = '00080018'
 _SOP_CLASS_UID_TAG = '00080016'
+_STUDY_INSTANCE_UID_TAG = '0020000D'
+_SERIES_INSTANCE_UID_TAG = '0020000E'
 
 _VALUE_TYPE = 'Value'
 
@@ -115,15 +139,25 @@ _SERIES_UID_INDEX = 12
 _NUM_RETRIES_CMLE = 5
 
 
+# Headers for receiving DICOM in JPEG Baseline format.
+_WADO_JPEG_ACCEPT = ('multipart/related; type="image/jpeg"; '
+                     'transfer-syntax=1.2.840.10008.1.2.4.50')
+# Headers for receiving DICOM instances uncompressed (Explicit VR Little
+# Endian), so that pydicom can decode their pixel data without the optional
+# decoders of compressed transfer syntaxes.
+_WADO_DICOM_ACCEPT = ('multipart/related; type="application/dicom"; '
+                      'transfer-syntax=1.2.840.10008.1.2.1')
+
+
 # TODO(b/111960222): Potentially add to ML toolkit.
-def _WadoRS(instance_path):
-  # type: str -> str
+def _WadoRS(instance_path, accept=_WADO_JPEG_ACCEPT):
+  # type: (str, str) -> str
   """Receives instance in JPEG format using WADO-RS protocol.
 
   WADO-RS is one of the standard protocols specified by DICOMWeb protocol. It
   allows clients to retrieve instances in various formats. In this case we will
-  retrieve the instance in JPEG format, from the Cloud Healthcare API specified
-  by _HEALTHCARE_API_URL_PREFIX.
+  retrieve the instance in JPEG format (unless requested otherwise), from the
+  Cloud Healthcare API specified by _HEALTHCARE_API_URL_PREFIX.
 
   Args:
     instance_path: Path of DICOM instance. This is found in the contents of the
@@ -131,23 +165,18 @@ def _WadoRS(instance_path):
         projects/{PROJECT_ID}/locations/{LOCATION_ID}/datasets/{DATASET_ID}/
         dicomStores/{DICOM_STORE_ID}/dicomWeb/studies/{STUDY_UID}/series/
         {SERIES_UID}/instances/{INSTANCE_UID}
+    accept: Accept header of the request, either _WADO_JPEG_ACCEPT or
+      _WADO_DICOM_ACCEPT.
 
   Returns:
-    content: The bytes for the JPEG image.
+    content: The bytes for the JPEG image, or the DICOM instance.
 
   Raises:
     RuntimeError: If failed to retrieve or process instance.
   """
   wado_url = os.path.join(_HEALTHCARE_API_URL_PREFIX, instance_path)
-  http = httplib2.Http()
-  http = _CREDENTIALS.authorize(http)
-
-  # Headers for receiving DICOM in JPEG Baseline format.
-  headers = {
-      'Accept': 'multipart/related; type="image/jpeg"; '
-                'transfer-syntax=1.2.840.10008.1.2.4.50'
-  }
-  resp, content = http.request(wado_url, 'GET', headers=headers)
+  headers = {'Accept': accept}
+  resp, content = _DICOMWEB_CLIENT.request(wado_url, 'GET', headers=headers)
   if resp.status != 200:
     raise RuntimeError(
         'Failed to retrieve DICOM instance: (%s, %s)' % (resp, content))
@@ -159,6 +188,68 @@ def _WadoRS(instance_path):
   return multipart_data.parts[0].content
 
 
+def _TranscodeToJpeg(dicom_bytes, image_size):
+  # type: (str, int) -> str
+  """Renders a DICOM instance as a JPEG image of the model input size.
+
+  The pixel data is decoded with pydicom, mapped to 8 bits using the VOI
+  window of the instance (or the full range of its values), and resized to
+  image_size x image_size, the size the model resizes its input images to.
+
+  Args:
+    dicom_bytes: Bytes of the DICOM instance.
+    image_size: Width and height of the JPEG image.
+
+  Returns:
+    The bytes for the JPEG image.
+  """
+  dataset = pydicom.dcmread(io.BytesIO(dicom_bytes))
+  pixels = dataset.pixel_array.astype(numpy.float32)
+  pixels = (pixels * float(getattr(dataset, 'RescaleSlope', 1)) +
+            float(getattr(dataset, 'RescaleIntercept', 0)))
+  if 'WindowCenter' in dataset and 'WindowWidth' in dataset:
+    center = dataset.WindowCenter
+    width = dataset.WindowWidth
+    # The attributes are multi-valued if there are alternative windows.
+    if isinstance(center, pydicom.multival.MultiValue):
+      center = center[0]
+    if isinstance(width, pydicom.multival.MultiValue):
+      width = width[0]
+    low = float(center) - float(width) / 2
+    high = float(center) + float(width) / 2
+  else:
+    low = pixels.min()
+    high = pixels.max()
+  pixels = numpy.clip((pixels - low) / max(high - low, 1e-6), 0, 1) * 255
+  if getattr(dataset, 'PhotometricInterpretation', '') == 'MONOCHROME1':
+    pixels = 255 - pixels
+
+  image = Image.fromarray(pixels.astype(numpy.uint8))
+  image = image.resize((image_size, image_size), Image.BILINEAR)
+  output = io.BytesIO()
+  image.save(output, format='JPEG', quality=95)
+  return output.getvalue()
+
+
+def _WadoRSAndTranscode(transcode_pool, image_size, instance_path):
+  # type: (multiprocessing.Pool, int, str) -> str
+  """Retrieves the DICOM instance, and transcodes it to JPEG in the pool.
+
+  This is an alternative to _WadoRS, which avoids the latency of transcoding
+  large instances in the Cloud Healthcare API.
+
+  Args:
+    transcode_pool: Process pool running _TranscodeToJpeg.
+    image_size: Width and height of the JPEG image.
+    instance_path: Path of DICOM instance, as for _WadoRS.
+
+  Returns:
+    The bytes for the JPEG image.
+  """
+  dicom_bytes = _WadoRS(instance_path, accept=_WADO_DICOM_ACCEPT)
+  return transcode_pool.apply(_TranscodeToJpeg, (dicom_bytes, image_size))
+
+
 # TODO(b/111960222): Potentially add to ML toolkit.
 def _StowRS(study_path, instance_bytes):
   # type: (str, str) -> None
@@ -178,25 +269,27 @@ def _StowRS(study_path, instance_bytes):
   Raises:
     RuntimeError: If failed to store instance.
   """
+  _StowRSInstances(study_path, [instance_bytes])
+
+
+def _StowRSInstances(study_path, instances_bytes):
+  # type: (str, List[str]) -> None
+  """Stores instances in Cloud Healthcare API in a single STOW-RS request.
+
+  Args:
+    study_path: Path of DICOM study, as for _StowRS. The instances may belong
+      to different studies.
+    instances_bytes: Bytes for each instance.
+
+  Raises:
+    RuntimeError: If failed to store any of the instances.
+  """
   stow_url = os.path.join(_HEALTHCARE_API_URL_PREFIX, study_path)
-  http = httplib2.Http()
-  http = _CREDENTIALS.authorize(http)
-
-  root = multipart.MIMEMultipart(
-      subtype='related', boundary=mimetools.choose_boundary())
-  # root should not write out its own headers
-  setattr(root, '_write_headers', lambda self: None)
-  part = application.MIMEApplication(
-      instance_bytes, 'dicom', _encoder=encoders.encode_noop)
-  root.attach(part)
-
-  boundary = root.get_boundary()
-  content_type = (
-      'multipart/related; type="application/dicom"; boundary="%s"') % boundary
-  headers = {'content-type': content_type}
-
-  resp, content = http.request(
-      stow_url, method='POST', body=root.as_string(), headers=headers)
+  body = dicomweb.MultipartRelatedBody(instances_bytes)
+  headers = {'content-type': body.content_type}
+
+  resp, content = _DICOMWEB_CLIENT.request(
+      stow_url, method='POST', body=body, headers=headers)
   if resp.status != 200:
     raise RuntimeError(
         'Failed to store DICOM instance in Healthcare API: (%s, %s)' %
@@ -222,9 +315,10 @@ def _QidoRs(qido_url):
   Raises:
     RuntimeError: if the response status was not 200.
   """
-  http = httplib2.Http()
-  http = _CREDENTIALS.authorize(http)
-  resp, content = http.request(qido_url, 'GET')
+  resp, content = _DICOMWEB_CLIENT.request(qido_url, 'GET')
+  # The response has no content if no instance matched the query.
+  if resp.status == 204:
+    return []
   if resp.status != 200:
     raise RuntimeError(
         'QidoRs error. Response Status: %d,\nURL: %s,\nContent: %s.' %
@@ -232,6 +326,71 @@ def _QidoRs(qido_url):
   return json.loads(content)
 
 
+def _QidoRsPages(qido_url, page_size):
+  # type: (str, int) -> Iterator[Dict]
+  """Yields the results of a QIDO-RS query, requested page_size at a time.
+
+  Args:
+    qido_url: URL for the QIDO request, without query parameters.
+    page_size: Max number of results requested at once.
+
+  Yields:
+    The parsed JSON of each result.
+
+  Raises:
+    RuntimeError: if the status of a response was not 200 or 204.
+  """
+  for offset in itertools.count(0, page_size):
+    page = _QidoRs('%s?limit=%d&offset=%d' % (qido_url, page_size, offset))
+    for result in page:
+      yield result
+    if len(page) < page_size:
+      return
+
+
+class _LatencyHistogram(object):
+  """Thread-safe histogram of latencies, with exponential buckets."""
+
+  # Upper bounds of the buckets, in milliseconds.
+  _BUCKETS_MSEC = [2**i for i in range(18)]
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._counts = [0] * (len(self._BUCKETS_MSEC) + 1)
+    self._count = 0
+    self._total_msec = 0.0
+
+  def Record(self, seconds):
+    # type: float -> None
+    msec = seconds * 1000
+    with self._lock:
+      self._counts[bisect.bisect_left(self._BUCKETS_MSEC, msec)] += 1
+      self._count += 1
+      self._total_msec += msec
+
+  def _Percentile(self, percentile):
+    # Returns the upper bound of the bucket containing the percentile.
+    rank = percentile / 100 * self._count
+    seen = 0
+    for bucket, count in enumerate(self._counts):
+      seen += count
+      if seen >= rank:
+        break
+    if bucket == len(self._BUCKETS_MSEC):
+      return float('inf')
+    return self._BUCKETS_MSEC[bucket]
+
+  def Summary(self):
+    # type: None -> str
+    """Returns the count, mean and (bucketed) percentiles of the latencies."""
+    with self._lock:
+      if not self._count:
+        return 'count=0'
+      return 'count=%d mean=%.1fms p50<=%sms p90<=%sms p99<=%sms' % (
+          self._count, self._total_msec / self._count, self._Percentile(50),
+          self._Percentile(90), self._Percentile(99))
+
+
 class Predictor(object):
   """ Abstract base class for ML Predictor."""
   __metaclass__ = abc.ABCMeta
@@ -242,20 +401,147 @@ class Predictor(object):
     """Runs inference and returns predicted class and score."""
     raise NotImplementedError
 
+  def LogStats(self):
+    # type: None -> None
+    """Logs statistics about the predictions, if any."""
+    pass
 
-class CMLEPredictor(Predictor):
-  """Handler for CMLE predictor.
+
+class _PendingItem(object):
+  """Item waiting to be processed as part of a batch, and its result."""
+
+  def __init__(self, item):
+    self.item = item
+    self.result = None
+    self.error = None
+    self.done = threading.Event()
+
+
+class _Batcher(object):
+  """Processes the items submitted by concurrent callers in batches.
+
+  Items passed to Submit are processed together, in batches of up to
+  max_batch_size items. A batch is processed as soon as it is full, or
+  max_batch_wait_secs after its first item was received. Batches are processed
+  by num_threads threads, each calling batch_fn(context, items), where context
+  is the value returned by create_context_fn in that thread (None if not set),
+  and items is the list of items of the batch. batch_fn must return the list of
+  the results of the items.
+  """
+
+  def __init__(self,
+               batch_fn,
+               max_batch_size,
+               max_batch_wait_secs,
+               num_threads,
+               create_context_fn=None):
+    self._batch_fn = batch_fn
+    self._max_batch_size = max_batch_size
+    self._max_batch_wait_secs = max_batch_wait_secs
+    self._create_context_fn = create_context_fn
+    self._queue = Queue.Queue()
+    for _ in range(num_threads):
+      thread = threading.Thread(target=self._ProcessBatches)
+      thread.daemon = True
+      thread.start()
+
+  def Submit(self, item):
+    # type: Any -> Any
+    """Waits for the item to be processed as part of a batch.
+
+    Args:
+      item: Item to process.
+
+    Returns:
+      The result of the item.
+
+    Raises:
+      Exception: The exception raised by batch_fn for the batch of the item.
+    """
+    pending = _PendingItem(item)
+    self._queue.put(pending)
+    pending.done.wait()
+    if pending.error:
+      raise pending.error
+    return pending.result
+
+  def _GetBatch(self):
+    # type: None -> List[_PendingItem]
+    """Waits for items to process, and returns a batch of them."""
+    batch = [self._queue.get()]
+    deadline = time.time() + self._max_batch_wait_secs
+    while len(batch) < self._max_batch_size:
+      timeout = deadline - time.time()
+      if timeout <= 0:
+        break
+      try:
+        batch.append(self._queue.get(timeout=timeout))
+      except Queue.Empty:
+        break
+    return batch
+
+  def _ProcessBatches(self):
+    context = None
+    if self._create_context_fn:
+      context = self._create_context_fn()
+    while True:
+      batch = self._GetBatch()
+      try:
+        results = self._batch_fn(context, [pending.item for pending in batch])
+        for pending, result in zip(batch, results):
+          pending.result = result
+      except Exception as e:  # pylint: disable=broad-except
+        for pending in batch:
+          pending.error = e
+      for pending in batch:
+        pending.done.set()
+
+
+def _GetScore(scores, index, batch_size):
+  # type: (Any, int, int) -> float
+  """Returns the score of the index-th image of a batch.
+
+  The exported model gathers the score of the predicted class of every image
+  of the batch, for each image. So, for batches of more than one image, the
+  scores of an image are a list, and its own is at its index in the batch.
+
+  Raises:
+    RuntimeError: If the scores of the image are a list that does not have
+      one score per image of the batch.
+  """
+  if isinstance(scores, (list, numpy.ndarray)):
+    if len(scores) != batch_size:
+      raise RuntimeError('Expected %d scores per image, got %d' %
+                         (batch_size, len(scores)))
+    return scores[index]
+  return scores
+
+
+class _BatchingPredictor(Predictor):
+  """Base class of predictors running predictions for batches of images.
+
+  Images passed to Predict by concurrent callers are predicted together, in
+  batches of up to max_batch_size images. A batch is predicted as soon as it is
+  full, or max_batch_wait_secs after its first image was received. Batches are
+  predicted by num_threads threads.
+
+  Subclasses must be fully initialized before calling __init__, which starts
+  the threads.
 
   Attributes:
-    model_path: Path to model.
+    max_batch_size: Max number of images in a batch.
+    max_batch_wait_secs: Max time to wait for more images to add to a batch.
+    num_threads: Max number of batches predicted concurrently.
   """
 
-  def __init__(self, model_path):
-    self._model_path = model_path
+  def __init__(self, max_batch_size, max_batch_wait_secs, num_threads):
+    self._batcher = _Batcher(self._PredictBatch, max_batch_size,
+                             max_batch_wait_secs, num_threads,
+                             self._CreateThreadContext)
 
   def Predict(self, image_jpeg_bytes):
     # type: str -> (str, str)
-    """Runs inference on image using Cloud ML Engine.
+    """Runs inference on image, as part of a batch.
 
     This will invoke the model with the given image and will return the
     predicted class and score.
@@ -272,7 +558,51 @@ class CMLEPredictor(Predictor):
     Raises:
       RuntimeError: if failed to get inference results.
     """
+    return self._batcher.Submit(image_jpeg_bytes)
+
+  def _CreateThreadContext(self):
+    # type: None -> Any
+    """Returns the object passed to _PredictBatch by the calling thread."""
+    return None
+
+  @abc.abstractmethod
+  def _PredictBatch(self, context, images_jpeg_bytes):
+    # type: (Any, List[str]) -> List[(str, str)]
+    """Returns the (class, score) tuple of each image."""
+    raise NotImplementedError
+
+
+class CMLEPredictor(_BatchingPredictor):
+  """Handler for CMLE predictor.
+
+  Images are sent to Cloud ML Engine in batches, one prediction request per
+  batch. Each thread sending requests reuses its own service client.
+
+  Attributes:
+    model_path: Path to model.
+    max_batch_size: Max number of images in a prediction request.
+    max_batch_wait_secs: Max time to wait for more images to add to a batch.
+    num_threads: Max number of concurrent prediction requests.
+  """
 
+  def __init__(self,
+               model_path,
+               max_batch_size=8,
+               max_batch_wait_secs=0.02,
+               num_threads=1):
+    self._model_path = model_path
+    super(CMLEPredictor, self).__init__(max_batch_size, max_batch_wait_secs,
+                                        num_threads)
+
+  def _CreateThreadContext(self):
+    # Disable cache discovery due to following issue:
+    # https://github.com/google/google-api-python-client/issues/299
+    # The service is not thread-safe, so each thread builds its own.
+    return googleapiclient.discovery.build('ml', 'v1', cache_discovery=False)
+
+  def _PredictBatch(self, service, images_jpeg_bytes):
+    # type: (Any, List[str]) -> List[(str, str)]
+    """Returns the (class, score) tuple of each image."""
     # CMLE requires images to be encoded in this format:
     # https://cloud.google.com/ml-engine/docs/v1/predict-request
     input_data = {
@@ -280,11 +610,8 @@ class CMLEPredictor(Predictor):
             'inputs': {
                 'b64': base64.b64encode(image_jpeg_bytes)
             }
-        }]
+        } for image_jpeg_bytes in images_jpeg_bytes]
     }
-    # Disable cache discovery due to following issue:
-    # https://github.com/google/google-api-python-client/issues/299
-    service = googleapiclient.discovery.build('ml', 'v1', cache_discovery=False)
     response = service.projects().predict(
         name=self._model_path,
         body=input_data).execute(num_retries=_NUM_RETRIES_CMLE)
@@ -292,21 +619,93 @@ class CMLEPredictor(Predictor):
     # Propagate the error.
     if 'error' in response:
       raise RuntimeError(response['error'])
+    if len(response['predictions']) != len(images_jpeg_bytes):
+      raise RuntimeError('CMLE returned %d predictions for %d images' %
+                         (len(response['predictions']), len(images_jpeg_bytes)))
 
     # Return the predictions.
-    prediction = response['predictions'][0]
-    return prediction['classes'], prediction['scores']
+    return [(prediction['classes'],
+             _GetScore(prediction['scores'], index, len(images_jpeg_bytes)))
+            for index, prediction in enumerate(response['predictions'])]
+
+
+class LocalPredictor(_BatchingPredictor):
+  """Handler for a SavedModel run in this process.
+
+  The model exported by trainer/model.py is loaded once, in a session shared by
+  all threads (TensorFlow sessions can be run concurrently), and images are
+  predicted in batches. This requires TensorFlow, which is not installed by
+  setup.py.
+
+  Attributes:
+    model_path: Path to the SavedModel directory, local or on GCS.
+    max_batch_size: Max number of images predicted together.
+    max_batch_wait_secs: Max time to wait for more images to add to a batch.
+    num_threads: Max number of batches predicted concurrently.
+  """
+
+  def __init__(self,
+               model_path,
+               max_batch_size=8,
+               max_batch_wait_secs=0.02,
+               num_threads=1):
+    import tensorflow as tf  # pylint: disable=g-import-not-at-top
+    start = time.time()
+    self._session = tf.Session(graph=tf.Graph())
+    meta_graph_def = tf.saved_model.loader.load(
+        self._session, [tf.saved_model.tag_constants.SERVING], model_path)
+    signature = meta_graph_def.signature_def[
+        tf.saved_model.signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY]
+    self._input_name = signature.inputs[
+        tf.saved_model.signature_constants.CLASSIFY_INPUTS].name
+    self._output_names = [
+        signature.outputs[
+            tf.saved_model.signature_constants.CLASSIFY_OUTPUT_CLASSES].name,
+        signature.outputs[
+            tf.saved_model.signature_constants.CLASSIFY_OUTPUT_SCORES].name,
+    ]
+    _logger.info('Loaded model %s in %.1fs', model_path, time.time() - start)
+    super(LocalPredictor, self).__init__(max_batch_size, max_batch_wait_secs,
+                                         num_threads)
+
+  def _PredictBatch(self, context, images_jpeg_bytes):
+    # type: (None, List[str]) -> List[(str, str)]
+    """Returns the (class, score) tuple of each image."""
+    classes, scores = self._session.run(
+        self._output_names, feed_dict={self._input_name: images_jpeg_bytes})
+    # One row of scores per image, as in Cloud ML Engine responses.
+    scores = numpy.reshape(scores, (len(images_jpeg_bytes), -1))
+    return [(classes[index],
+             float(_GetScore(scores[index], index, len(images_jpeg_bytes))))
+            for index in range(len(images_jpeg_bytes))]
 
 
 class AutoMLPredictor(Predictor):
   """Handler for AutoML Vision predictor.
 
+  The prediction clients are created once, and shared by all callers. gRPC
+  multiplexes concurrent requests over the channel of a client, and requests
+  are spread over num_clients clients (and so channels) in turn.
+
   Attributes:
     model_path: Path to model.
+    num_clients: Number of prediction clients.
+    max_in_flight: Max number of concurrent prediction requests. Callers block
+      while it is reached.
   """
 
-  def __init__(self, model_path):
+  def __init__(self, model_path, num_clients=1, max_in_flight=8):
     self._model_path = model_path
+    start = time.time()
+    self._clients = [
+        automl_v1beta1.PredictionServiceClient() for _ in range(num_clients)
+    ]
+    _logger.info('Created %d AutoML prediction clients in %.1fms', num_clients,
+                 (time.time() - start) * 1000)
+    self._next_client = itertools.cycle(self._clients)
+    self._next_client_lock = threading.Lock()
+    self._in_flight = threading.BoundedSemaphore(max_in_flight)
+    self._latency = _LatencyHistogram()
 
   def Predict(self, image_jpeg_bytes):
     # type: str -> (str, str)
@@ -329,13 +728,21 @@ class AutoMLPredictor(Predictor):
     """
     payload = {'image': {'image_bytes': image_jpeg_bytes}}
     params = {}
-    prediction_client = automl_v1beta1.PredictionServiceClient()
-    response = prediction_client.predict(self._model_path, payload, params)
+    with self._next_client_lock:
+      prediction_client = next(self._next_client)
+    with self._in_flight:
+      start = time.time()
+      response = prediction_client.predict(self._model_path, payload, params)
+      self._latency.Record(time.time() - start)
     if len(response.payload) != 1:
       raise RuntimeError('AutoML response payload size should be of size 1')
     result = response.payload[0]
     return result.display_name, result.classification.score
 
+  def LogStats(self):
+    # type: None -> None
+    _logger.info('AutoML request latency: %s', self._latency.Summary())
+
 
 # TODO(b/111960222): Potentially add to ML toolkit.
 def _BuildSR(text, study_uid, series_uid, instance_uid):
@@ -373,20 +780,245 @@ def _BuildSR(text, study_uid, series_uid, instance_uid):
   return bytestring
 
 
+class _LruCache(object):
+  """Thread-safe map of bounded size, evicting the least recently used keys."""
+
+  def __init__(self, max_size):
+    self._max_size = max_size
+    self._items = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def Get(self, key, default=None):
+    with self._lock:
+      if key not in self._items:
+        return default
+      value = self._items.pop(key)
+      self._items[key] = value
+      return value
+
+  def Put(self, key, value):
+    with self._lock:
+      self._items.pop(key, None)
+      self._items[key] = value
+      if len(self._items) > self._max_size:
+        self._items.popitem(last=False)
+
+  def Items(self):
+    # type: None -> List[Tuple[Any, Any]]
+    """Returns the (key, value) pairs, from least to most recently used."""
+    with self._lock:
+      return self._items.items()
+
+
+class _PredictionCache(object):
+  """LRU cache of predictions, optionally persisted to a JSON-lines file.
+
+  Each prediction put in the cache is appended to the file, and the last
+  max_size ones are loaded back when the cache is created, so that a restarted
+  module does not predict the same instances again. The file is then rewritten
+  with only the loaded predictions, so that it does not grow across restarts.
+  """
+
+  def __init__(self, max_size, path=None):
+    self._cache = _LruCache(max_size)
+    self._file = None
+    self._file_lock = threading.Lock()
+    if path:
+      if os.path.exists(path):
+        with open(path) as f:
+          for line in f:
+            try:
+              record = json.loads(line)
+            except ValueError:
+              # The last line may be truncated if the module was killed.
+              continue
+            self._cache.Put(record['key'], tuple(record['prediction']))
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+          for key, prediction in self._cache.Items():
+            f.write(json.dumps({'key': key, 'prediction': prediction}) + '\n')
+        os.rename(temp_path, path)
+      self._file = open(path, 'a')
+
+  def Get(self, key):
+    # type: str -> Optional[(str, str)]
+    return self._cache.Get(key)
+
+  def Put(self, key, prediction):
+    # type: (str, (str, str)) -> None
+    self._cache.Put(key, prediction)
+    if self._file:
+      with self._file_lock:
+        self._file.write(
+            json.dumps({
+                'key': key,
+                'prediction': prediction
+            }) + '\n')
+        self._file.flush()
+
+
+class _Stage(object):
+  """Pool of worker threads processing the tasks of a bounded queue.
+
+  Each task is passed to the stage function. If it returns True, the task is
+  then put in the queue of the next stage. Putting a task in a full queue
+  blocks, which applies backpressure to the previous stage.
+
+  Attributes:
+    name: Name of the stage, used for logging.
+    latency: Histogram of the time spent in the stage function.
+  """
+
+  def __init__(self, name, fn, num_workers, queue_size):
+    self.name = name
+    self.latency = _LatencyHistogram()
+    self._fn = fn
+    self._num_workers = num_workers
+    self._queue = Queue.Queue(maxsize=queue_size)
+    self._next_stage = None
+    for _ in range(num_workers):
+      worker = threading.Thread(target=self._Work, name=name)
+      worker.daemon = True
+      worker.start()
+
+  def SetNextStage(self, next_stage):
+    # type: _Stage -> None
+    self._next_stage = next_stage
+
+  def GetCapacity(self):
+    # type: None -> int
+    """Returns the max number of tasks in the stage."""
+    return self._num_workers + self._queue.maxsize
+
+  def Put(self, task):
+    # type: _Task -> None
+    self._queue.put(task)
+
+  def _Work(self):
+    while True:
+      task = self._queue.get()
+      start = time.time()
+      try:
+        forward = self._fn(task)
+      except Exception as e:  # pylint: disable=broad-except
+        _logger.exception('Error in %s stage for instance %s: %s', self.name,
+                          task.instance_path, e)
+        task.message.nack()
+        forward = False
+      self.latency.Record(time.time() - start)
+      if forward and self._next_stage:
+        self._next_stage.Put(task)
+
+
+class _Task(object):
+  """State of a Pubsub message going through the stages of the handler."""
+
+  def __init__(self, message):
+    self.message = message
+    self.instance_path = message.data
+    self.received_time = time.time()
+    self.image_jpeg_bytes = None
+    self.prediction = None
+    self.text = None
+    self.structured_report_path = None
+
+
 class PubsubMessageHandler(object):
   """Handler for incoming Pubsub messages.
 
+  Messages are processed by a pipeline of stages (filter, fetch, predict,
+  store and publish), each with its own pool of worker threads and bounded
+  queue, so that multiple messages are processed concurrently and a slow stage
+  does not hold the worker threads of the others.
+
   Attributes:
     predictor: Object used to get prediction results.
     dicom_store_path: DICOM store used to store inference results.
+    stage_workers: Map of stage name to its number of worker threads. Stages
+      that are not in the map have 1 worker.
+    queue_size: Max number of tasks waiting in the queue of each stage.
+    stats_every: Log the latency of each stage every this many processed
+      messages. Never if 0.
+    filter_cache_size: Max number of SOP Instance UIDs of structured reports,
+      and of filtering decisions, to remember.
+    prediction_cache: Cache of the predictions of instances, by SOP Instance
+      UID and by hash of the JPEG image. Instances with a cached prediction are
+      not retrieved, or not predicted again. An instance stored again with the
+      same SOP Instance UID but different pixel data keeps its cached
+      prediction. Disabled if None.
+    fetch_image_fn: Function returning the JPEG image of an instance, given its
+      path. Defaults to _WadoRS.
+    sr_batch_size: Max number of structured reports stored in one STOW-RS
+      request. Storing more than one at once requires several store workers.
+    sr_batch_wait_secs: Max time to wait for more structured reports to add to
+      a STOW-RS request.
   """
 
-  def __init__(self, predictor, dicom_store_path):
+  STAGES = ('filter', 'fetch', 'predict', 'store', 'publish')
+
+  def __init__(self,
+               predictor,
+               dicom_store_path,
+               stage_workers=None,
+               queue_size=8,
+               stats_every=0,
+               filter_cache_size=10000,
+               prediction_cache=None,
+               fetch_image_fn=None,
+               sr_batch_size=1,
+               sr_batch_wait_secs=0.1):
     self._predictor = predictor
+    self._fetch_image_fn = fetch_image_fn or _WadoRS
+    self._prediction_cache = prediction_cache
+    # How each prediction was obtained: 'uid_cache', 'hash_cache' or
+    # 'predictor'.
+    self._prediction_stats = collections.Counter()
+    self._prediction_stats_lock = threading.Lock()
     self._dicom_store_path = dicom_store_path
+    self._stats_every = stats_every
+    # SOP Instance UIDs of the structured reports stored by this handler.
+    self._stored_sr_uids = _LruCache(filter_cache_size)
+    # Map of SOP Instance UID to whether its notifications are filtered.
+    self._filter_decisions = _LruCache(filter_cache_size)
+    # How each filtering decision was made: 'stored_sr', 'cached' or 'qido'.
+    self._filter_stats = collections.Counter()
+    self._filter_stats_lock = threading.Lock()
     self._success_count = 0
+    self._success_count_lock = threading.Lock()
+    self._end_to_end_latency = _LatencyHistogram()
     self.publisher = pubsub_v1.PublisherClient()
 
+    stage_workers = stage_workers or {}
+    self._sr_batcher = None
+    if sr_batch_size > 1:
+      # Every store worker waits for the batch of its structured report, so
+      # there is no point in more concurrent batches than workers.
+      self._sr_batcher = _Batcher(self._StoreBatch, sr_batch_size,
+                                  sr_batch_wait_secs,
+                                  stage_workers.get('store', 1))
+    stage_fns = {
+        'filter': self._Filter,
+        'fetch': self._Fetch,
+        'predict': self._Predict,
+        'store': self._Store,
+        'publish': self._Publish,
+    }
+    self._stages = [
+        _Stage(name, stage_fns[name], stage_workers.get(name, 1), queue_size)
+        for name in self.STAGES
+    ]
+    for stage, next_stage in zip(self._stages, self._stages[1:]):
+      stage.SetNextStage(next_stage)
+
+  def GetCapacity(self):
+    # type: None -> int
+    """Returns the max number of messages being processed at once.
+
+    This is the max number of messages that should be leased from Pubsub: more
+    would only wait in the subscriber, while their ack deadline runs.
+    """
+    return sum(stage.GetCapacity() for stage in self._stages)
+
   def _ShouldFilterMessage(self, instance_path):
     # type: pubsub_v1.Message -> bool
     """Returns whether to filter the given pubsub message.
@@ -395,6 +1027,9 @@ class PubsubMessageHandler(object):
     original DICOM instances and the Structured Reports. We need to filter out
     SRs such that only DICOM instances are processed.
 
+    The structured reports stored by this handler, and the instances seen
+    recently, are filtered without querying the DICOM store.
+
     Args:
       instance_path: Path of DICOM instances.
 
@@ -404,15 +1039,45 @@ class PubsubMessageHandler(object):
     split_instance_path = instance_path.split('/')
     removed_instance_uid_path = os.path.join(*split_instance_path[:-1])
     instance_uid = split_instance_path[-1]
+    if self._stored_sr_uids.Get(instance_uid):
+      self._CountFilterDecision('stored_sr')
+      return True
+    should_filter = self._filter_decisions.Get(instance_uid)
+    if should_filter is not None:
+      self._CountFilterDecision('cached')
+      return should_filter
+
     qido_url = (
         '%s/%s?%s=%s' % (_HEALTHCARE_API_URL_PREFIX, removed_instance_uid_path,
                          _SOP_INSTANCE_UID_TAG, instance_uid))
 
     # The content is JSON containing a list of DICOM instances
     parsed_content = _QidoRs(qido_url)
+    self._CountFilterDecision('qido')
     # TODO(jonluca) find a better filtering algorithm
     sop_class_uid = parsed_content[0][_SOP_CLASS_UID_TAG][_VALUE_TYPE][0]
-    return sop_class_uid == _STRUCTURED_REPORT_ID
+    should_filter = sop_class_uid == _STRUCTURED_REPORT_ID
+    self._filter_decisions.Put(instance_uid, should_filter)
+    return should_filter
+
+  def RecordSopClass(self, sop_instance_uid, sop_class_uid):
+    # type: (str, str) -> None
+    """Records the SOP Class UID of an instance about to be processed.
+
+    The notification of the instance is then filtered without querying the
+    DICOM store, as for instances seen recently.
+
+    Args:
+      sop_instance_uid: SOP Instance UID of the instance.
+      sop_class_uid: SOP Class UID of the instance.
+    """
+    self._filter_decisions.Put(sop_instance_uid,
+                               sop_class_uid == _STRUCTURED_REPORT_ID)
+
+  def _CountFilterDecision(self, source):
+    # type: str -> None
+    with self._filter_stats_lock:
+      self._filter_stats[source] += 1
 
   def _PublishInferenceResultsReady(self, image_instance_path):
     # type: str -> None
@@ -439,7 +1104,6 @@ class PubsubMessageHandler(object):
     except TypeError as e:
       _logger.error('Invalid type sent to publish channel: %s', e.message)
 
-
   def PubsubCallback(self, message):
     # type: pubsub_v1.Message -> None
     """Processess a Pubsub message.
@@ -451,96 +1115,402 @@ class PubsubMessageHandler(object):
     to the Structured Report containing the prediction is then published to a
     pub/sub.
 
+    The message is only queued for processing by the stages of the handler. This
+    blocks while the queue of the first stage is full.
+
     Args:
       message: Incoming pubsub message.
     """
-    image_instance_path = message.data
-    _logger.debug('Received instance in pubsub feed: %s', image_instance_path)
+    _logger.debug('Received instance in pubsub feed: %s', message.data)
+    self._stages[0].Put(_Task(message))
+
+  def _Filter(self, task):
+    # type: _Task -> bool
     # Filter messages that correspond to inference results or that don't match
     # the type of image we are expecting
-    if self._ShouldFilterMessage(image_instance_path):
-      message.ack()
-      return
-
-    _logger.info('Processing instance: %s', image_instance_path)
+    if self._ShouldFilterMessage(task.instance_path):
+      task.message.ack()
+      return False
+    _logger.info('Processing instance: %s', task.instance_path)
+    return True
+
+  def _Fetch(self, task):
+    # type: _Task -> bool
+    # Redelivered notifications, or instances stored again, do not need to be
+    # retrieved if their prediction is cached.
+    if self._prediction_cache:
+      sop_instance_uid = task.instance_path.split('/')[-1]
+      task.prediction = self._prediction_cache.Get('uid:' + sop_instance_uid)
+      if task.prediction:
+        self._CountPrediction('uid_cache')
+        return True
 
     # Retrieve instance from DICOM API in JPEG format.
-    image_jpeg_bytes = _WadoRS(image_instance_path)
-
-    # Get the predicted score and class from the inference model in Cloud ML or
-    # AutoML.
-    try:
-      predicted_class, predicted_score = self._predictor.Predict(
-          image_jpeg_bytes)
-    except PermissionDenied as e:
-      _logger.error('Permission error running prediction service: %s',
-                    e.message)
-      message.nack()
-      return
-    except InvalidArgument as e:
-      _logger.error('Invalid arguments when running prediction service: %s',
-                    e.message)
-      message.nack()
-      return
+    task.image_jpeg_bytes = self._fetch_image_fn(task.instance_path)
+    return True
+
+  def _Predict(self, task):
+    # type: _Task -> bool
+    if not task.prediction:
+      image_hash_key = None
+      if self._prediction_cache:
+        image_hash_key = 'sha256:' + hashlib.sha256(
+            task.image_jpeg_bytes).hexdigest()
+        task.prediction = self._prediction_cache.Get(image_hash_key)
+        if task.prediction:
+          self._CountPrediction('hash_cache')
+
+      if not task.prediction:
+        # Get the predicted score and class from the inference model in Cloud
+        # ML or AutoML.
+        try:
+          task.prediction = self._predictor.Predict(task.image_jpeg_bytes)
+        except PermissionDenied as e:
+          _logger.error('Permission error running prediction service: %s',
+                        e.message)
+          task.message.nack()
+          return False
+        except InvalidArgument as e:
+          _logger.error('Invalid arguments when running prediction service: %s',
+                        e.message)
+          task.message.nack()
+          return False
+        self._CountPrediction('predictor')
+        if self._prediction_cache:
+          self._prediction_cache.Put(image_hash_key, task.prediction)
+
+      if self._prediction_cache:
+        sop_instance_uid = task.instance_path.split('/')[-1]
+        self._prediction_cache.Put('uid:' + sop_instance_uid, task.prediction)
+    task.image_jpeg_bytes = None
+    predicted_class, predicted_score = task.prediction
 
     # Print the prediction.
-    text = 'Base path: %s\nPredicted class: %s\nPredicted score: %s' % (
-        image_instance_path, predicted_class, predicted_score)
-    _logger.info(text)
+    task.text = 'Base path: %s\nPredicted class: %s\nPredicted score: %s' % (
+        task.instance_path, predicted_class, predicted_score)
+    _logger.info(task.text)
+    return True
+
+  def _CountPrediction(self, source):
+    # type: str -> None
+    with self._prediction_stats_lock:
+      self._prediction_stats[source] += 1
 
+  def _Store(self, task):
+    # type: _Task -> bool
     # If user requested destination DICOM store for inference, create a DICOM
     # structured report that stores the prediction.
-    if self._dicom_store_path:
-      # Generate (study_uid, series_uid, instance_uid) triplet for presentation
-      # state. The study_uid and series_uid will be the same as the original
-      # instance and extracted from Pubsub path:
-      # projects/{PROJECT_ID}/locations/{LOCATION_ID}/datasets/{DATASET_ID}/
-      # dicomStores/{DICOM_STORE_ID}/dicomWeb/studies/{STUDY_UID}/series/
-      # {SERIES_UID}/instances/{INSTANCE_UID}
-      split_image_instance_path = image_instance_path.split('/')
-      sr_study_uid = split_image_instance_path[_STUDY_UID_INDEX]
-      sr_series_uid = split_image_instance_path[_SERIES_UID_INDEX]
-      # Set instance_uid to random number.
-      sr_instance_uid = pydicom.uid.generate_uid()
-
-      # Store the DICOM structured report in same series using Healthcare API.
-      dicom_sr = _BuildSR(text, sr_study_uid, sr_series_uid, sr_instance_uid)
-      study_path = os.path.join(self._dicom_store_path, 'dicomWeb', 'studies')
-      try:
+    if not self._dicom_store_path:
+      return True
+
+    # Generate (study_uid, series_uid, instance_uid) triplet for presentation
+    # state. The study_uid and series_uid will be the same as the original
+    # instance and extracted from Pubsub path:
+    # projects/{PROJECT_ID}/locations/{LOCATION_ID}/datasets/{DATASET_ID}/
+    # dicomStores/{DICOM_STORE_ID}/dicomWeb/studies/{STUDY_UID}/series/
+    # {SERIES_UID}/instances/{INSTANCE_UID}
+    split_image_instance_path = task.instance_path.split('/')
+    sr_study_uid = split_image_instance_path[_STUDY_UID_INDEX]
+    sr_series_uid = split_image_instance_path[_SERIES_UID_INDEX]
+    # Set instance_uid to random number.
+    sr_instance_uid = pydicom.uid.generate_uid()
+
+    # Store the DICOM structured report in same series using Healthcare API.
+    dicom_sr = _BuildSR(task.text, sr_study_uid, sr_series_uid,
+                        sr_instance_uid)
+    # Record the UID first, the notification for the SR may arrive before
+    # _StowRS returns.
+    self._stored_sr_uids.Put(sr_instance_uid, True)
+    study_path = os.path.join(self._dicom_store_path, 'dicomWeb', 'studies')
+    try:
+      if self._sr_batcher:
+        self._sr_batcher.Submit(dicom_sr)
+      else:
         _StowRS(study_path, dicom_sr)
-      except RuntimeError as e:
-        _logger.error('Error storing DICOM in API: %s', e.message)
-        message.nack()
-        return
-
-      # If user requested that new structured reports be published to a channel,
-      # publish the instance path of the Structured Report
-      structured_report_path = os.path.join(study_path, sr_study_uid, 'series',
-                                            sr_series_uid, 'instances',
-                                            sr_instance_uid)
-      self._PublishInferenceResultsReady(structured_report_path)
+    except RuntimeError as e:
+      _logger.error('Error storing DICOM in API: %s', e.message)
+      task.message.nack()
+      return False
+
+    task.structured_report_path = os.path.join(
+        study_path, sr_study_uid, 'series', sr_series_uid, 'instances',
+        sr_instance_uid)
+    return True
+
+  def _StoreBatch(self, context, dicom_srs):
+    # type: (None, List[str]) -> List[None]
+    """Stores a batch of structured reports in a single STOW-RS request."""
+    del context  # Unused.
+    study_path = os.path.join(self._dicom_store_path, 'dicomWeb', 'studies')
+    _StowRSInstances(study_path, dicom_srs)
+    return [None] * len(dicom_srs)
+
+  def _Publish(self, task):
+    # type: _Task -> bool
+    # If user requested that new structured reports be published to a channel,
+    # publish the instance path of the Structured Report
+    if task.structured_report_path:
+      self._PublishInferenceResultsReady(task.structured_report_path)
 
     # Ack the message (successful or invalid message).
-    message.ack()
-    self._success_count += 1
+    task.message.ack()
+    self._end_to_end_latency.Record(time.time() - task.received_time)
+    with self._success_count_lock:
+      self._success_count += 1
+      success_count = self._success_count
+    if self._stats_every and success_count % self._stats_every == 0:
+      self.LogStats()
+    return False
+
+  def LogStats(self):
+    # type: None -> None
+    """Logs the latency of each stage, and of whole messages."""
+    for stage in self._stages:
+      _logger.info('Stage %s latency: %s', stage.name, stage.latency.Summary())
+    _logger.info('End to end latency: %s', self._end_to_end_latency.Summary())
+    with self._filter_stats_lock:
+      filter_stats = dict(self._filter_stats)
+    total = sum(filter_stats.values())
+    if total:
+      _logger.info(
+          'Filtering decisions: %d, from stored SRs: %d, cached: %d, QIDO-RS '
+          'queries: %d (%.1f%% avoided)', total,
+          filter_stats.get('stored_sr', 0), filter_stats.get('cached', 0),
+          filter_stats.get('qido', 0),
+          100 * (total - filter_stats.get('qido', 0)) / total)
+    with self._prediction_stats_lock:
+      prediction_stats = dict(self._prediction_stats)
+    if self._prediction_cache:
+      _logger.info(
+          'Predictions: from SOP Instance UID cache: %d, from image hash '
+          'cache: %d, from predictor: %d', prediction_stats.get('uid_cache', 0),
+          prediction_stats.get('hash_cache', 0),
+          prediction_stats.get('predictor', 0))
+    self._predictor.LogStats()
 
   def GetSuccessCount(self):
     # type: None -> int
     """Returns the number of Pubsub messages successfully processed."""
-    return self._success_count
+    with self._success_count_lock:
+      return self._success_count
+
+
+def _ListInstances(dicom_store_path, page_size):
+  # type: (str, int) -> Iterator[(str, str)]
+  """Yields the path and SOP Class UID of each instance of a DICOM store.
+
+  The studies of the store are listed with QIDO-RS, then the instances of each
+  study. All the instances of a study are listed before any is yielded, so that
+  the structured reports stored in the study while its instances are processed
+  do not shift the pages of the listing.
+
+  Args:
+    dicom_store_path: Path of the DICOM store. This should be formatted as
+      follows: projects/{PROJECT_ID}/locations/{LOCATION_ID}/datasets/
+      {DATASET_ID}/dicomStores/{DICOM_STORE_ID}
+    page_size: Max number of studies, or instances, requested at once.
+
+  Yields:
+    (instance_path, sop_class_uid) tuples, where instance_path is formatted as
+    the paths found in Pubsub messages.
+  """
+  studies_path = os.path.join(dicom_store_path, 'dicomWeb', 'studies')
+  studies_url = os.path.join(_HEALTHCARE_API_URL_PREFIX, studies_path)
+  for study in _QidoRsPages(studies_url, page_size):
+    study_uid = study[_STUDY_INSTANCE_UID_TAG][_VALUE_TYPE][0]
+    instances = list(
+        _QidoRsPages(
+            os.path.join(studies_url, study_uid, 'instances'), page_size))
+    for instance in instances:
+      yield (os.path.join(
+          studies_path, study_uid, 'series',
+          instance[_SERIES_INSTANCE_UID_TAG][_VALUE_TYPE][0], 'instances',
+          instance[_SOP_INSTANCE_UID_TAG][_VALUE_TYPE][0]),
+             instance[_SOP_CLASS_UID_TAG][_VALUE_TYPE][0])
+
+
+class _BulkCheckpoint(object):
+  """JSON-lines file recording the instances processed by bulk inference.
+
+  Each line records the outcome of an instance, either 'done' or 'failed'. When
+  bulk inference is run again, the instances done are skipped, and the failed
+  ones are processed again.
+  """
+
+  def __init__(self, path):
+    self._done = set()
+    if os.path.exists(path):
+      with open(path) as f:
+        for line in f:
+          try:
+            record = json.loads(line)
+          except ValueError:
+            # The last line may be truncated if the module was killed.
+            continue
+          if record['state'] == 'done':
+            self._done.add(record['instance'])
+    self._file = open(path, 'a')
+    self._lock = threading.Lock()
+
+  def IsDone(self, sop_instance_uid):
+    # type: str -> bool
+    return sop_instance_uid in self._done
+
+  def Record(self, sop_instance_uid, state):
+    # type: (str, str) -> None
+    with self._lock:
+      if state == 'done':
+        self._done.add(sop_instance_uid)
+      self._file.write(
+          json.dumps({
+              'instance': sop_instance_uid,
+              'state': state
+          }) + '\n')
+      self._file.flush()
+
+  def Close(self):
+    # type: None -> None
+    with self._lock:
+      self._file.close()
+
+
+class _BulkMessage(object):
+  """Stands in for a Pubsub message of an instance listed by bulk inference.
+
+  Acking or nacking the message calls callback(instance_path, success).
+  """
+
+  def __init__(self, instance_path, callback):
+    self.data = instance_path
+    self._callback = callback
+
+  def ack(self):  # pylint: disable=invalid-name
+    self._callback(self.data, True)
+
+  def nack(self):  # pylint: disable=invalid-name
+    self._callback(self.data, False)
+
+
+def _RunBulk(handler, dicom_store_path, checkpoint, page_size, report_every):
+  # type: (PubsubMessageHandler, str, _BulkCheckpoint, int, int) -> int
+  """Runs inference on every instance of a DICOM store.
+
+  The instances are listed with QIDO-RS, and processed by the stages of the
+  handler, as if a Pubsub notification had been received for each of them.
+  Listing blocks while the queue of the first stage is full, so it only runs
+  ahead of the processing by the capacity of the handler. The structured
+  reports of the store, and the instances recorded as done in the checkpoint,
+  are not processed.
+
+  Args:
+    handler: Handler processing the instances.
+    dicom_store_path: Path of the DICOM store whose instances are processed.
+    checkpoint: Records the outcome of each instance.
+    page_size: Max number of studies, or instances, listed at once.
+    report_every: Log the progress every this many processed instances. Never
+      if 0.
+
+  Returns:
+    The number of instances that failed to be processed.
+  """
+  counts = collections.Counter()
+  condition = threading.Condition()
+
+  def _Done(instance_path, success):
+    checkpoint.Record(instance_path.split('/')[-1],
+                      'done' if success else 'failed')
+    with condition:
+      counts['pending'] -= 1
+      counts['done' if success else 'failed'] += 1
+      processed = counts['done'] + counts['failed']
+      if report_every and processed % report_every == 0:
+        _logger.info('Bulk inference: %d instances done, %d failed, %d skipped',
+                     counts['done'], counts['failed'], counts['skipped'])
+      condition.notify_all()
+
+  for instance_path, sop_class_uid in _ListInstances(dicom_store_path,
+                                                     page_size):
+    sop_instance_uid = instance_path.split('/')[-1]
+    if (sop_class_uid == _STRUCTURED_REPORT_ID or
+        checkpoint.IsDone(sop_instance_uid)):
+      with condition:
+        counts['skipped'] += 1
+      continue
+    handler.RecordSopClass(sop_instance_uid, sop_class_uid)
+    with condition:
+      counts['pending'] += 1
+    handler.PubsubCallback(_BulkMessage(instance_path, _Done))
+
+  with condition:
+    while counts['pending']:
+      # Wait with a timeout, so that KeyboardInterrupt is raised.
+      condition.wait(1)
+  _logger.info('Bulk inference finished: %d instances done, %d failed, %d '
+               'skipped', counts['done'], counts['failed'], counts['skipped'])
+  return counts['failed']
 
 
 def main():
+  global _DICOMWEB_CLIENT
+  fetch_image_fn = _WadoRS
+  if FLAGS.transcoding == 'client':
+    # Fork the processes first, before the predictors start threads or create
+    # gRPC channels, which are not safe to fork.
+    transcode_pool = multiprocessing.Pool(FLAGS.transcode_processes)
+    fetch_image_fn = functools.partial(_WadoRSAndTranscode, transcode_pool,
+                                       FLAGS.image_size)
+
+  _DICOMWEB_CLIENT = dicomweb.DicomWebClient(
+      _CREDENTIALS,
+      timeout=FLAGS.dicomweb_timeout_secs,
+      max_retries=FLAGS.dicomweb_max_retries)
+
   if FLAGS.prediction_service == 'CMLE':
-    predictor = CMLEPredictor(FLAGS.model_path)
+    predictor = CMLEPredictor(FLAGS.model_path, FLAGS.max_batch_size,
+                              FLAGS.max_batch_wait_ms / 1000,
+                              FLAGS.max_concurrent_batches)
   elif FLAGS.prediction_service == 'AutoML':
-    predictor = AutoMLPredictor(FLAGS.model_path)
+    predictor = AutoMLPredictor(FLAGS.model_path, FLAGS.automl_num_clients,
+                                FLAGS.automl_max_in_flight)
   else:
-    raise ValueError('FLAGS.prediction_service must be CMLE or AutoML.')
+    predictor = LocalPredictor(FLAGS.model_path, FLAGS.max_batch_size,
+                               FLAGS.max_batch_wait_ms / 1000,
+                               FLAGS.max_concurrent_batches)
+
+  prediction_cache = None
+  if FLAGS.prediction_cache_size:
+    prediction_cache = _PredictionCache(FLAGS.prediction_cache_size,
+                                        FLAGS.prediction_cache_path)
+  stage_workers = {
+      stage: getattr(FLAGS, '%s_workers' % stage)
+      for stage in PubsubMessageHandler.STAGES
+  }
+  handler = PubsubMessageHandler(predictor, FLAGS.dicom_store_path,
+                                 stage_workers, FLAGS.queue_size,
+                                 FLAGS.stats_every, FLAGS.filter_cache_size,
+                                 prediction_cache, fetch_image_fn,
+                                 FLAGS.sr_batch_size,
+                                 FLAGS.sr_batch_wait_ms / 1000)
+  if FLAGS.bulk_dicom_store_path:
+    checkpoint = _BulkCheckpoint(FLAGS.bulk_checkpoint_path)
+    try:
+      num_failed = _RunBulk(handler, FLAGS.bulk_dicom_store_path, checkpoint,
+                            FLAGS.bulk_page_size, FLAGS.stats_every)
+    finally:
+      checkpoint.Close()
+      handler.LogStats()
+    if num_failed:
+      sys.exit(1)
+    return
 
-  handler = PubsubMessageHandler(predictor, FLAGS.dicom_store_path)
   subscriber = pubsub_v1.SubscriberClient()
-  future = subscriber.subscribe(FLAGS.subscription_path, handler.PubsubCallback)
+  # Only lease as many messages as the handler can hold.
+  flow_control = pubsub_v1.types.FlowControl(
+      max_messages=handler.GetCapacity())
+  future = subscriber.subscribe(
+      FLAGS.subscription_path,
+      handler.PubsubCallback,
+      flow_control=flow_control)
   try:
     # If timeout is set, wait for FLAGS.pubsub_timeout seconds until messages
     # are processed on the pubsub channel.
@@ -554,6 +1524,8 @@ def main():
     future.cancel()
     assert (handler.GetSuccessCount() >
             0), 'Timeout but no pubsub messages successfully processed'
+  finally:
+    handler.LogStats()
 
 
 if __name__ == '__main__':
@@ -561,12 +1533,31 @@ if __name__ == '__main__':
   parser.add_argument(
       '--subscription_path',
       type=str,
-      required=True,
+      default=None,
       help=
       'Pub/Sub Subscription ID associated with the topic for notifications of '
       'new DICOM instances. The Inference Module subscribes to notifications on'
       ' this channel and runs inference on new DICOM instances added to the '
       'store.')
+  parser.add_argument(
+      '--bulk_dicom_store_path',
+      type=str,
+      default=None,
+      help='If set, runs inference on every instance already in this DICOM '
+      'store, then exits, instead of subscribing to --subscription_path.')
+  parser.add_argument(
+      '--bulk_checkpoint_path',
+      type=str,
+      default='bulk_inference_checkpoint.jsonl',
+      help='File recording the instances processed by bulk inference. '
+      'Instances recorded as done are skipped when bulk inference is run '
+      'again.')
+  parser.add_argument(
+      '--bulk_page_size',
+      type=int,
+      default=1000,
+      help='Max number of studies, or instances, listed by each QIDO-RS '
+      'request of bulk inference.')
   parser.add_argument(
       '--publisher_topic_path',
       type=str,
@@ -579,7 +1570,8 @@ if __name__ == '__main__':
       '--model_path',
       type=str,
       required=True,
-      help='Path of Cloud ML Engine model used for inference.')
+      help='Path of Cloud ML Engine model used for inference, or of the '
+      'SavedModel directory with --prediction_service=Local.')
   parser.add_argument(
       '--dicom_store_path',
       type=str,
@@ -591,7 +1583,37 @@ if __name__ == '__main__':
       '--prediction_service',
       type=str,
       default='CMLE',
-      help='Service to call for prediction, either "CMLE" or "AutoML"')
+      choices=['CMLE', 'AutoML', 'Local'],
+      help='Service to call for prediction, either "CMLE", "AutoML" or "Local" '
+      '(runs the SavedModel in this process, requires TensorFlow)')
+  parser.add_argument(
+      '--max_batch_size',
+      type=int,
+      default=8,
+      help='Max number of images sent to Cloud ML Engine in one prediction '
+      'request, or predicted together by the Local predictor.')
+  parser.add_argument(
+      '--max_batch_wait_ms',
+      type=int,
+      default=20,
+      help='Max time to wait for more images to add to a prediction request.')
+  parser.add_argument(
+      '--max_concurrent_batches',
+      type=int,
+      default=2,
+      help='Max number of concurrent prediction requests to Cloud ML Engine, '
+      'or of batches predicted concurrently by the Local predictor.')
+  parser.add_argument(
+      '--automl_num_clients',
+      type=int,
+      default=2,
+      help='Number of AutoML prediction clients (gRPC channels) to spread '
+      'requests over.')
+  parser.add_argument(
+      '--automl_max_in_flight',
+      type=int,
+      default=8,
+      help='Max number of concurrent prediction requests to AutoML.')
   parser.add_argument(
       '--pubsub_timeout',
       type=int,
@@ -599,8 +1621,114 @@ if __name__ == '__main__':
       help=
       'Number of seconds to wait for pubsub message to process until timeout. '
       'If set to None, it will wait indefinitely.')
+  parser.add_argument(
+      '--filter_workers',
+      type=int,
+      default=4,
+      help='Number of threads filtering out notifications of inference '
+      'results.')
+  parser.add_argument(
+      '--fetch_workers',
+      type=int,
+      default=4,
+      help='Number of threads retrieving instances from the DICOM store.')
+  parser.add_argument(
+      '--predict_workers',
+      type=int,
+      default=4,
+      help='Number of threads running predictions.')
+  parser.add_argument(
+      '--store_workers',
+      type=int,
+      default=4,
+      help='Number of threads storing inference results in the DICOM store.')
+  parser.add_argument(
+      '--publish_workers',
+      type=int,
+      default=1,
+      help='Number of threads publishing results ready notifications.')
+  parser.add_argument(
+      '--queue_size',
+      type=int,
+      default=8,
+      help='Max number of messages waiting for each stage of processing. The '
+      'number of messages leased from Pub/Sub is limited to what the queues and '
+      'threads of all stages can hold.')
+  parser.add_argument(
+      '--dicomweb_timeout_secs',
+      type=int,
+      default=60,
+      help='Timeout of DICOMweb requests to the Cloud Healthcare API.')
+  parser.add_argument(
+      '--dicomweb_max_retries',
+      type=int,
+      default=3,
+      help='Max number of times a failed DICOMweb request is retried.')
+  parser.add_argument(
+      '--transcoding',
+      type=str,
+      default='server',
+      choices=['server', 'client'],
+      help='Where instances are transcoded to JPEG: "server" requests JPEG '
+      'images from the Cloud Healthcare API, "client" retrieves DICOM '
+      'instances and transcodes them locally.')
+  parser.add_argument(
+      '--transcode_processes',
+      type=int,
+      default=None,
+      help='Number of processes transcoding instances to JPEG, if '
+      '--transcoding=client. Defaults to the number of CPUs.')
+  parser.add_argument(
+      '--image_size',
+      type=int,
+      default=299,
+      help='Width and height of the JPEG images transcoded locally, the input '
+      'size of the model (299 for Inception V3).')
+  parser.add_argument(
+      '--filter_cache_size',
+      type=int,
+      default=10000,
+      help='Max number of structured reports stored by this module, and of '
+      'recently seen instances, to filter without querying the DICOM store.')
+  parser.add_argument(
+      '--prediction_cache_size',
+      type=int,
+      default=10000,
+      help='Max number of predictions to cache, by SOP Instance UID and by '
+      'image hash, so that duplicate instances are not predicted again. '
+      'Instances are not retrieved again if their SOP Instance UID is cached, '
+      'so an instance stored again with different pixel data but the same SOP '
+      'Instance UID keeps its previous prediction. Disabled if 0.')
+  parser.add_argument(
+      '--prediction_cache_path',
+      type=str,
+      default=None,
+      help='If set, cached predictions are also appended to this file, and '
+      'loaded from it on startup.')
+  parser.add_argument(
+      '--sr_batch_size',
+      type=int,
+      default=1,
+      help='Max number of structured reports stored in one STOW-RS request. '
+      'Should not exceed --store_workers, which each wait for the request of '
+      'their structured report.')
+  parser.add_argument(
+      '--sr_batch_wait_ms',
+      type=int,
+      default=100,
+      help='Max time to wait for more structured reports to add to a STOW-RS '
+      'request.')
+  parser.add_argument(
+      '--stats_every',
+      type=int,
+      default=100,
+      help='Log the latency of each stage every this many processed messages. '
+      'Never if 0.')
 
   FLAGS, unparsed = parser.parse_known_args()
+  if not FLAGS.subscription_path and not FLAGS.bulk_dicom_store_path:
+    parser.error('Either --subscription_path or --bulk_dicom_store_path must '
+                 'be set.')
   if FLAGS.publisher_topic_path and not FLAGS.dicom_store_path:
     parser.error('--publisher_topic_path requires --dicom_store_path '
                  'to be set.')
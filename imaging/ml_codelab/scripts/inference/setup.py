@@ -16,6 +16,8 @@ from setuptools import setup
 
 REQUIRED_PACKAGES = [
     'pydicom',
+    'numpy',
+    'Pillow',
     'requests-toolbelt',
     'google-api-python-client',
     'google-api-core',
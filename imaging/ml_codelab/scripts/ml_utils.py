@@ -13,34 +13,67 @@
 # limitations under the License.
 """Utility functions for training and serving ML models."""
 
+import hashlib
+import logging
+import os
+import threading
+import time
 import warnings
 
 # TODO(b/112609807): Remove when Tensorflow library is updated.
 warnings.filterwarnings('ignore')
 import tensorflow as tf
 import tensorflow_hub
+import scripts.constants as constants
 
 # URL to the trained neural net, which gets feature vectors from images. It is a
 # checkpoint of Inception V3 model trained on ImageNet with the few last
 # classification layers stripped.
-_FEATURE_VECTORS_MODULE_URL = 'https://tfhub.dev/google/imagenet/inception_v3/feature_vector/1'
+FEATURE_VECTORS_MODULE_URL = 'https://tfhub.dev/google/imagenet/inception_v3/feature_vector/1'
 
+# Spec of the module at FEATURE_VECTORS_MODULE_URL, loaded once per process.
+_module_spec = None
+_module_spec_lock = threading.Lock()
 
-def get_bottleneck_tensor(input_jpeg_str):
-  # type: tf.Tensor -> tf.Tensor
-  """Calculates the bottleneck tensor for input JPEG string tensor.
 
-  This function will resize/encode the image as required by Inception V3 model.
-  Then it will run it through the InceptionV3 checkpoint to calculate
-  bottleneck values.
+def get_module_spec(cache_dir=None):
+  # type: Optional[str] -> tensorflow_hub.ModuleSpec
+  """Returns the spec of the feature vectors module.
+
+  The module is downloaded and its spec is loaded only once per process, later
+  calls return the same spec.
+
+  Args:
+    cache_dir: Local or GCS directory to cache downloaded modules in. Only used
+      by the first call in a process. Workers sharing the same directory only
+      download the module once.
+
+  Returns:
+    The module spec.
+  """
+  global _module_spec
+  with _module_spec_lock:
+    if _module_spec is None:
+      if cache_dir:
+        os.environ['TFHUB_CACHE_DIR'] = cache_dir
+      start = time.time()
+      _module_spec = tensorflow_hub.load_module_spec(FEATURE_VECTORS_MODULE_URL)
+      logging.info('Loaded module %s in %.1fs', FEATURE_VECTORS_MODULE_URL,
+                   time.time() - start)
+  return _module_spec
+
+
+def _decode_and_resize_image(input_jpeg_str, module_spec):
+  # type: (tf.Tensor, tensorflow_hub.ModuleSpec) -> tf.Tensor
+  """Decodes a JPEG string tensor and resizes it to the module input size.
 
   Args:
     input_jpeg_str: Tensor for input JPEG image.
+    module_spec: Spec of the module the image is fed to.
 
   Returns:
-    bottleneck_tensor: Tensor for output bottleneck Tensor.
+    A 4-D float Tensor holding a batch of one image.
   """
-  module_spec = tensorflow_hub.load_module_spec(_FEATURE_VECTORS_MODULE_URL)
   input_height, input_width = tensorflow_hub.get_expected_image_size(
       module_spec)
   input_depth = tensorflow_hub.get_num_image_channels(module_spec)
@@ -50,8 +83,73 @@ def get_bottleneck_tensor(input_jpeg_str):
   decoded_image_4d = tf.expand_dims(decoded_image_as_float, 0)
   resize_shape = tf.stack([input_height, input_width])
   resize_shape_as_int = tf.cast(resize_shape, dtype=tf.int32)
-  resized_image_4d = tf.image.resize_bilinear(decoded_image_4d,
-                                              resize_shape_as_int)
+  return tf.image.resize_bilinear(decoded_image_4d, resize_shape_as_int)
+
+
+def get_bottleneck_tensor(input_jpeg_str):
+  # type: tf.Tensor -> tf.Tensor
+  """Calculates the bottleneck tensor for input JPEG string tensor.
+
+  This function will resize/encode the image as required by Inception V3 model.
+  Then it will run it through the InceptionV3 checkpoint to calculate
+  bottleneck values.
+
+  Args:
+    input_jpeg_str: Tensor for input JPEG image.
+
+  Returns:
+    bottleneck_tensor: Tensor for output bottleneck Tensor.
+  """
+  module_spec = get_module_spec()
+  resized_image_4d = _decode_and_resize_image(input_jpeg_str, module_spec)
   m = tensorflow_hub.Module(module_spec)
   bottleneck_tensor = m(resized_image_4d)
   return bottleneck_tensor
+
+
+def get_batch_bottleneck_tensor(input_jpeg_strs):
+  # type: tf.Tensor -> tf.Tensor
+  """Calculates the bottleneck tensor for a batch of JPEG string tensors.
+
+  Same as get_bottleneck_tensor, except that the images are decoded and resized
+  one by one, then run through the InceptionV3 checkpoint as a single batch.
+
+  Args:
+    input_jpeg_strs: 1-D Tensor of input JPEG images.
+
+  Returns:
+    bottleneck_tensor: Tensor for output bottlenecks, one row per image.
+  """
+  module_spec = get_module_spec()
+  resized_images = tf.map_fn(
+      lambda s: tf.squeeze(_decode_and_resize_image(s, module_spec), [0]),
+      input_jpeg_strs,
+      back_prop=False,
+      dtype=tf.float32)
+  m = tensorflow_hub.Module(module_spec)
+  bottleneck_tensor = m(resized_images)
+  return bottleneck_tensor
+
+
+def get_dataset_split(study_uid, validation_percentage, testing_percentage):
+  # type: (str, int, int) -> str
+  """Deterministically assigns a study to the training/validation/test set.
+
+  The assignment only depends on a hash of the study UID, so all images of a
+  study end up in the same dataset, and a study stays in the same dataset
+  across runs as long as the percentages are unchanged.
+
+  Args:
+    study_uid: Study Instance UID of the image.
+    validation_percentage: Percentage of studies in the validation set.
+    testing_percentage: Percentage of studies in the test set.
+
+  Returns:
+    One of the training, validation or testing dataset names in constants.
+  """
+  bucket = int(hashlib.sha256(study_uid).hexdigest(), 16) % 100
+  if bucket < testing_percentage:
+    return constants.TESTING_DATASET
+  if bucket < testing_percentage + validation_percentage:
+    return constants.VALIDATION_DATASET
+  return constants.TRAINING_DATASET
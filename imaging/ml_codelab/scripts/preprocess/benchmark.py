@@ -0,0 +1,88 @@
+# Copyright 2018 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmarks the bottleneck calculation of preprocess.py on the DirectRunner.
+
+The same images are run through the batching and bottleneck steps of the
+preprocessing pipeline once per batch size, and the throughput (images/sec) of
+each run is logged. The TensorFlow graph is built before the first run, so the
+numbers do not include the cold start.
+
+Example usage:
+
+python -m scripts.preprocess.benchmark \
+    --input_path gs://<bucket_name> --num_images 256 --batch_sizes 1,8,32
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import logging
+import os
+import sys
+import time
+import apache_beam as beam
+from apache_beam.options.pipeline_options import PipelineOptions
+import scripts.preprocess.preprocess as preprocess
+from tensorflow.python.lib.io import file_io
+
+
+def _run_pipeline(elements, batch_size):
+  # type: (List[Tuple[str, str, str]], int) -> float
+  """Runs the bottleneck steps over elements, and returns the images/sec."""
+  options = PipelineOptions.from_dictionary({'runner': 'DirectRunner'})
+  start = time.time()
+  with beam.Pipeline(options=options) as p:
+    _ = (
+        p
+        | 'Create' >> beam.Create(elements)
+        | 'Batch Images' >> beam.BatchElements(
+            min_batch_size=batch_size, max_batch_size=batch_size)
+        | 'Preprocess Image' >> beam.ParDo(preprocess.PreprocessImage()))
+  return len(elements) / (time.time() - start)
+
+
+def main(argv):
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      '--input_path',
+      required=True,
+      help='Path to input directory of images, same as for preprocess.py.')
+  parser.add_argument(
+      '--num_images',
+      type=int,
+      default=256,
+      help='Number of images to benchmark with.')
+  parser.add_argument(
+      '--batch_sizes',
+      default='1,8,32',
+      help='Comma separated list of batch sizes to benchmark.')
+  args = parser.parse_args(argv)
+
+  image_paths = file_io.get_matching_files(
+      os.path.join(args.input_path, '*/*/*'))[:args.num_images]
+  elements = [('benchmark', path, 'benchmark') for path in image_paths]
+
+  # Build the graph up front, it is shared by all runs.
+  preprocess.PreprocessImage().start_bundle()
+
+  for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+    images_per_sec = _run_pipeline(elements, batch_size)
+    logging.info('Batch size %d: %.2f images/sec', batch_size, images_per_sec)
+
+
+if __name__ == '__main__':
+  logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+  main(sys.argv[1:])
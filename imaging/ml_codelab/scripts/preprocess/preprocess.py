@@ -23,6 +23,11 @@ split the input dataset (specified by --image_dir) into a training,
 validation and test sets. The percentage of each can be specified by using
 the --validation_percentage and --testing_percentage flags.
 
+With --split_at_read_time, the dataset is not split here. All bottlenecks are
+written to the same set of TFRecords and model.py splits them by a hash of the
+study UID when reading them, so that different split percentages can be tried
+without running this pipeline again.
+
 The output of this script is TFRecords containing the "bottleneck" for each
 image. A "bottleneck" is the feature vector output from the checkpoint model (in
 this case Inception V3). We are calculating the bottlenecks so they can be fed
@@ -32,13 +37,19 @@ the output of the feature extraction part of the model.
 
 import warnings
 import argparse
+from collections import defaultdict
 import csv
+import hashlib
+import json
 import logging
+from multiprocessing.pool import ThreadPool
 import os
 import random
 import StringIO
 import sys
 import threading
+import time
+import uuid
 import apache_beam as beam
 from apache_beam.options.pipeline_options import PipelineOptions
 import httplib2
@@ -57,17 +68,19 @@ _BREAST_DENSITY_3_LABEL = '3'
 
 
 class PreprocessGraph(object):
-  """ Creates a TF graph to preprocess an image and to calculate bottlenecks.
+  """ Creates a TF graph to preprocess images and to calculate bottlenecks.
   Example usage:
   # Create the Tensorflow graph.
   preprocess_graph = PreprocessGraph(sess)
 
-  # Calculate bottlenecks for an input image.
-  bottleneck = preprocess_graph.calculate_bottleneck(input_image)
-  return bottleneck
+  # Calculate bottlenecks for a batch of input images.
+  bottlenecks = preprocess_graph.calculate_bottlenecks(input_images)
+  return bottlenecks
   """
 
-  def __init__(self):
+  def __init__(self, module_cache_dir=None):
+    # type: Optional[str] -> None
+    self._module_cache_dir = module_cache_dir
     graph = tf.Graph()
     self._tf_session = tf.Session(graph=graph)
     with graph.as_default():
@@ -79,38 +92,51 @@ class PreprocessGraph(object):
     """Builds the processing graph.
 
     Returns:
-      (input_jpeg_str, bottleneck_tensor) tuple.
+      (input_jpeg_strs, bottleneck_tensor) tuple.
 
-      input_jpeg_str is a Tensor for input JPEG image.
+      input_jpeg_strs is a Tensor for a batch of input JPEG images.
       bottleneck_tensor is a Tensor for output bottleneck Tensor.
     """
 
-    input_jpeg_str = tf.placeholder(tf.string)
+    input_jpeg_strs = tf.placeholder(tf.string, shape=[None])
     # Make ml_utils a local import. This means that ml_utils does not have
     # to be installed on machine that starts the workers, it only needs to be
     # installed on the workers themselves. This makes dependency management a
     # bit easier.
     # https://cloud.google.com/dataflow/faq
     import scripts.ml_utils as ml_utils
-    bottleneck_tensor = ml_utils.get_bottleneck_tensor(input_jpeg_str)
-    return input_jpeg_str, bottleneck_tensor
+    ml_utils.get_module_spec(self._module_cache_dir)
+    bottleneck_tensor = ml_utils.get_batch_bottleneck_tensor(input_jpeg_strs)
+    return input_jpeg_strs, bottleneck_tensor
+
+  def calculate_bottlenecks(self, images_bytes):
+    # type: List[str] -> np.ndarray
+    """Returns the bottlenecks for a batch of images, one row per image."""
+
+    return self._tf_session.run(
+        self._bottleneck_tensor,
+        feed_dict={self._input_jpeg_tensor: images_bytes})
 
   def calculate_bottleneck(self, image_bytes):
     # type: str -> np.ndarray
     """Returns the bottleneck for an image."""
 
-    bottleneck = self._tf_session.run(
-        self._bottleneck_tensor,
-        feed_dict={self._input_jpeg_tensor: image_bytes})
-    return np.squeeze(bottleneck)
+    return self.calculate_bottlenecks([image_bytes])[0]
+
+
+def _get_study_uid(image_path):
+  # type: str -> str
+  """Returns the study UID of an image at gs://<bucket>/<study_uid>/..."""
+  return image_path.split('/')[3]
 
 
 def _to_tfrecord(dataset, image_path, label, bottleneck):
-  # type: (str, str, str, List[float]) -> tensorflow.train.Example
+  # type: (Optional[str], str, str, List[float]) -> tensorflow.train.Example
   """Converts input into a TFRecord.
 
   Args:
-    dataset: String indicator of dataset - training, validation or test.
+    dataset: String indicator of dataset - training, validation or test. None
+      if the dataset is split when the TFRecords are read.
     image_path: Path of input image in GCS
     label: Label associated with the image.
     bottleneck: The bottleneck vector.
@@ -125,24 +151,98 @@ def _to_tfrecord(dataset, image_path, label, bottleneck):
   def _float_feature(value):
     return tf.train.Feature(float_list=tf.train.FloatList(value=value))
 
-  example = tf.train.Example(
-      features=tf.train.Features(
-          feature={
-              'dataset': _bytes_feature(dataset),
-              'image_path': _bytes_feature(image_path),
-              'label': _bytes_feature(label),
-              'bottleneck': _float_feature(bottleneck)
-          }))
+  feature = {
+      'image_path': _bytes_feature(image_path),
+      'study_uid': _bytes_feature(_get_study_uid(image_path)),
+      'label': _bytes_feature(label),
+      'bottleneck': _float_feature(bottleneck)
+  }
+  if dataset is not None:
+    feature['dataset'] = _bytes_feature(dataset)
+  example = tf.train.Example(features=tf.train.Features(feature=feature))
   return example
 
 
+class BottleneckCache(object):
+  """Content-addressed cache of bottlenecks.
+
+  Bottlenecks are keyed by a hash of the image bytes and of the URL of the
+  module computing them, so they are reused across runs regardless of how the
+  dataset is split, and are invalidated when the module changes. Each
+  bottleneck is stored as raw float32 values in its own file under cache_path.
+  Files of an unexpected size are treated as missing, so that an interrupted
+  write never yields a corrupt bottleneck. GCS objects only become visible
+  once fully written, so they are written in place; local files are written
+  under a temporary name and renamed into place.
+
+  Every lookup and write is a round trip to GCS, so the bottlenecks of a batch
+  are looked up and written in parallel.
+  """
+
+  def __init__(self, cache_path, module_url, num_threads=16):
+    # type: (str, str, int) -> None
+    self._cache_path = cache_path
+    self._module_url = module_url
+    self._pool = ThreadPool(num_threads)
+
+  def _path(self, image_bytes):
+    # type: str -> str
+    digest = hashlib.sha256()
+    digest.update(self._module_url)
+    digest.update(b'\0')
+    digest.update(image_bytes)
+    return os.path.join(self._cache_path, digest.hexdigest())
+
+  def get(self, image_bytes):
+    # type: str -> Optional[np.ndarray]
+    """Returns the cached bottleneck for an image, or None if missing."""
+    path = self._path(image_bytes)
+    try:
+      data = file_io.FileIO(path, 'rb').read()
+    except tf.errors.NotFoundError:
+      return None
+    if len(data) != constants.BOTTLENECK_SIZE * np.dtype(np.float32).itemsize:
+      logging.warning('Ignoring cached bottleneck %s of %d bytes', path,
+                      len(data))
+      return None
+    return np.frombuffer(data, dtype=np.float32)
+
+  def put(self, image_bytes, bottleneck):
+    # type: (str, np.ndarray) -> None
+    """Stores the bottleneck for an image."""
+    path = self._path(image_bytes)
+    data = np.asarray(bottleneck, dtype=np.float32).tostring()
+    if path.startswith('gs://'):
+      file_io.write_string_to_file(path, data)
+      return
+    temp_path = '%s.tmp-%s' % (path, uuid.uuid4().hex)
+    file_io.write_string_to_file(temp_path, data)
+    file_io.rename(temp_path, path, overwrite=True)
+
+  def get_many(self, images_bytes):
+    # type: List[str] -> List[Optional[np.ndarray]]
+    """Looks up the cached bottlenecks of several images in parallel."""
+    return self._pool.map(self.get, images_bytes)
+
+  def put_many(self, images_bytes, bottlenecks):
+    # type: (List[str], List[np.ndarray]) -> None
+    """Stores the bottlenecks of several images in parallel."""
+    self._pool.map(lambda args: self.put(*args),
+                   zip(images_bytes, bottlenecks))
+
+
 class PreprocessImage(beam.DoFn):
-  """Workflow step to preprocess input images.
+  """Workflow step to preprocess batches of input images.
 
   This workflow step does the following:
-  1) Reads input image from GCS
-  2) Resize and encodes the image as required by Inception V3 model.
-  3) Calculate Inception V3 bottleneck and stores it as a TFRecord.
+  1) Reads a batch of input images from GCS
+  2) Resize and encodes the images as required by Inception V3 model.
+  3) Calculate Inception V3 bottlenecks for the whole batch in a single run of
+     the graph and stores them as TFRecords.
+
+  The input elements are expected to be batched by beam.BatchElements. If a
+  bottleneck cache path is given, bottlenecks are looked up in a
+  BottleneckCache first and only the missing ones are calculated.
   """
 
   # Synchronization for Beam variables that can be called from multiple threads.
@@ -150,53 +250,169 @@ class PreprocessImage(beam.DoFn):
   _preprocess_graph_lock = threading.Lock()
   _preprocess_graph = None
 
+  def __init__(self, bottleneck_cache_path=None, module_cache_dir=None):
+    # type: (Optional[str], Optional[str]) -> None
+    super(PreprocessImage, self).__init__()
+    self._bottleneck_cache_path = bottleneck_cache_path
+    self._module_cache_dir = module_cache_dir
+    self._bottleneck_cache = None
+    self._cache_hits = beam.metrics.Metrics.counter(self.__class__,
+                                                    'bottleneck_cache_hits')
+    self._cache_misses = beam.metrics.Metrics.counter(self.__class__,
+                                                      'bottleneck_cache_misses')
+    self._graph_build_msec = beam.metrics.Metrics.distribution(
+        self.__class__, 'graph_build_msec')
+
   def start_bundle(self):
     # type: None -> None
     """Starts an Apache Beam bundle.
 
-    We cache the Tensorflow session per bundle to avoid cold starts for the
-    processing of each element.
+    We cache the Tensorflow session per process to avoid cold starts for the
+    processing of each element. The time it takes to build it is logged and
+    reported in the graph_build_msec distribution.
     """
-    with self._preprocess_graph_lock:
-      if self._preprocess_graph is None:
-        self._preprocess_graph = PreprocessGraph()
+    with PreprocessImage._preprocess_graph_lock:
+      if PreprocessImage._preprocess_graph is None:
+        start = time.time()
+        PreprocessImage._preprocess_graph = PreprocessGraph(
+            self._module_cache_dir)
+        elapsed = time.time() - start
+        self._graph_build_msec.update(int(elapsed * 1000))
+        logging.info('Built preprocessing graph in %.1fs', elapsed)
+    if self._bottleneck_cache_path and self._bottleneck_cache is None:
+      # Local import, see PreprocessGraph._build_graph.
+      import scripts.ml_utils as ml_utils
+      self._bottleneck_cache = BottleneckCache(
+          self._bottleneck_cache_path, ml_utils.FEATURE_VECTORS_MODULE_URL)
 
   def process(self, element):
-    # type: beam.PCollection -> Iterable[tensorflow.TFRecord]
-    """Calculates the bottleneck for an image.
+    # type: List[Tuple[str, str, str]] -> Iterable[tensorflow.TFRecord]
+    """Calculates the bottlenecks for a batch of images.
 
     Args:
-      element: A beam.PCollection holding the (dataset, image_path, label).
+      element: A list of (dataset, image_path, label) tuples.
 
     Yields:
-      TFRecord holding (image_path, label, bottleneck).
+      TFRecord holding (image_path, label, bottleneck), one per image.
 
     Raises:
       RuntimeError: If _preprocess_graph is not initialized.
     """
-    (dataset, image_path, label) = element
-    image_data = file_io.FileIO(image_path, 'rb').read()
     if self._preprocess_graph is None:
       raise RuntimeError('self._preprocess_graph not initialized')
-    bottleneck = self._preprocess_graph.calculate_bottleneck(image_data)
-    yield _to_tfrecord(dataset, image_path, label, bottleneck)
+    images_data = [
+        file_io.FileIO(image_path, 'rb').read() for _, image_path, _ in element
+    ]
+    bottlenecks = [None] * len(images_data)
+    if self._bottleneck_cache:
+      bottlenecks = self._bottleneck_cache.get_many(images_data)
+    missing = [i for i, b in enumerate(bottlenecks) if b is None]
+    self._cache_hits.inc(len(bottlenecks) - len(missing))
+    self._cache_misses.inc(len(missing))
+
+    if missing:
+      calculated = self._preprocess_graph.calculate_bottlenecks(
+          [images_data[i] for i in missing])
+      for i, bottleneck in zip(missing, calculated):
+        bottlenecks[i] = bottleneck
+      if self._bottleneck_cache:
+        self._bottleneck_cache.put_many([images_data[i] for i in missing],
+                                        calculated)
+
+    for (dataset, image_path, label), bottleneck in zip(element, bottlenecks):
+      yield _to_tfrecord(dataset, image_path, label, bottleneck)
+
+
+def _list_study_images(study_dir):
+  # type: str -> List[str]
+  """Lists the images of a study, at <study_dir>/<series_uid>/<instance_uid>."""
+  return file_io.get_matching_files(os.path.join(study_dir, '*/*'))
+
 
+def _list_study_dirs(input_path):
+  # type: str -> List[str]
+  """Lists the sorted names of the study directories in input_path."""
+  return sorted(d.rstrip('/') for d in file_io.list_directory(input_path))
 
-def _get_study_uid_to_image_path_map(input_path):
-  # type: str -> Dict[str, str]
-  """Helper to run a map of study_uid to image path.
+
+def _build_study_uid_to_image_paths_map(input_path, study_dirs, num_threads):
+  # type: (str, List[str], int) -> Dict[str, List[str]]
+  """Lists the images of all studies, one study directory per request.
 
   Args:
     input_path: Input path of images.
+    study_dirs: Names of the study directories in input_path.
+    num_threads: Number of study directories to list in parallel.
 
   Returns:
-    study_uid_to_file_paths: Dictionary mapping study_uid to image path.
+    Dictionary mapping study_uid to the sorted paths of all its images.
   """
-  path_list = file_io.get_matching_files(os.path.join(input_path, '*/*/*'))
-  study_uid_to_file_paths = {}
-  for path in path_list:
-    split_path = path.split('/')
-    study_uid_to_file_paths[split_path[3]] = path
+  study_dirs = [os.path.join(input_path, d) for d in study_dirs]
+  pool = ThreadPool(num_threads)
+  try:
+    path_lists = pool.map(_list_study_images, study_dirs)
+  finally:
+    pool.close()
+    pool.join()
+
+  study_uid_to_file_paths = defaultdict(list)
+  for path_list in path_lists:
+    for path in path_list:
+      study_uid_to_file_paths[_get_study_uid(path)].append(path)
+  return {k: sorted(v) for k, v in study_uid_to_file_paths.iteritems()}
+
+
+def _get_study_uid_to_image_paths_map(input_path,
+                                      index_path=None,
+                                      rebuild_index=False,
+                                      num_threads=16):
+  # type: (str, Optional[str], bool, int) -> Dict[str, List[str]]
+  """Helper to get a map of study_uid to the paths of its images.
+
+  Listing a large bucket takes a while, so the map can be stored as a JSON
+  index at index_path and reused by later runs. The index records the
+  input_path and the study directories it was built from, and is rebuilt if
+  either does not match, e.g. when studies were added. Images added to an
+  existing study are not detected and need rebuild_index.
+
+  Args:
+    input_path: Input path of images.
+    index_path: Local or GCS path of the index. If None, the map is not
+      persisted.
+    rebuild_index: Whether to list the images again even if the index exists.
+    num_threads: Number of study directories to list in parallel.
+
+  Returns:
+    study_uid_to_file_paths: Dictionary mapping study_uid to image paths.
+  """
+  study_dirs = _list_study_dirs(input_path)
+  if index_path and not rebuild_index and file_io.file_exists(index_path):
+    index = json.loads(file_io.read_file_to_string(index_path))
+    if (index.get('input_path') == input_path and
+        index.get('study_dirs') == study_dirs):
+      study_uid_to_file_paths = {
+          str(k): [str(p) for p in v]
+          for k, v in index['studies'].iteritems()
+      }
+      logging.info('Read image index from %s, covering %d images of %d studies',
+                   index_path, sum(map(len, study_uid_to_file_paths.values())),
+                   len(study_uid_to_file_paths))
+      return study_uid_to_file_paths
+    logging.info('Ignoring stale image index %s, built from other studies',
+                 index_path)
+
+  study_uid_to_file_paths = _build_study_uid_to_image_paths_map(
+      input_path, study_dirs, num_threads)
+  if index_path:
+    logging.info('Writing image index covering %d images of %d studies to %s',
+                 sum(map(len, study_uid_to_file_paths.values())),
+                 len(study_uid_to_file_paths), index_path)
+    index = {
+        'input_path': input_path,
+        'study_dirs': study_dirs,
+        'studies': study_uid_to_file_paths
+    }
+    file_io.write_string_to_file(index_path, json.dumps(index, sort_keys=True))
   return study_uid_to_file_paths
 
 
@@ -209,14 +425,50 @@ def _partition_fn(element, unused_num_partitions):
   return 2
 
 
+def _configure_unsplit_pipeline(p, opt, study_uid_to_label,
+                                study_uid_to_image_paths):
+  # Type: (apache_beam.Pipeline, apache_beam.PipelineOptions, Dict[str, str],
+  #        Dict[str, List[str]]) -> None
+  """Writes bottlenecks of all images into a single set of TFRecords."""
+  paths_and_labels = []
+  for k, v in study_uid_to_label.iteritems():
+    if k not in study_uid_to_image_paths:
+      logging.warning('Could not find image with study_uid %s in GCS', k)
+      continue
+    for path in study_uid_to_image_paths[k]:
+      paths_and_labels.append((None, path, v))
+  logging.info('Number of images: %s', len(paths_and_labels))
+
+  _ = (
+      p
+      | 'Download Labels' >> beam.Create(paths_and_labels)
+      | 'Batch Images' >> beam.BatchElements(
+          min_batch_size=opt.min_batch_size,
+          max_batch_size=opt.max_batch_size)
+      | 'Preprocess Image' >> beam.ParDo(
+          PreprocessImage(opt.bottleneck_cache_path,
+                          opt.tfhub_cache_dir))
+      | 'Serialize TFRecord' >> beam.Map(lambda x: x.SerializeToString())
+      | 'Save TFRecord to GCS' >> beam.io.WriteToTFRecord(
+          os.path.join(opt.output_path, constants.UNSPLIT_DATASET),
+          file_name_suffix='.tfrecord'))
+
+
 def configure_pipeline(p, opt):
   # Type: (apache_beam.Pipeline, apache_beam.PipelineOptions) -> None
   """Specify PCollection and transformations in pipeline."""
   # Create a map of study_uid to label.
   study_uid_to_label = tcia_utils.GetStudyUIDToLabelMap()
 
-  # Create a map of study_uid -> path of images in GCS
-  study_uid_to_image_path = _get_study_uid_to_image_path_map(opt.input_path)
+  # Create a map of study_uid -> paths of images in GCS
+  study_uid_to_image_paths = _get_study_uid_to_image_paths_map(
+      opt.input_path, opt.image_index_path, opt.rebuild_image_index,
+      opt.listing_threads)
+
+  if opt.split_at_read_time:
+    _configure_unsplit_pipeline(p, opt, study_uid_to_label,
+                                study_uid_to_image_paths)
+    return
 
   # Create a map of study_uid -> (GCS path, label)
   # Split dataset into training, validation and test.
@@ -232,7 +484,7 @@ def configure_pipeline(p, opt):
 
   count = 0
   for k, v in study_uid_to_label.iteritems():
-    if k not in study_uid_to_image_path:
+    if k not in study_uid_to_image_paths:
       logging.warning('Could not find image with study_uid %s in GCS', k)
       continue
     if count < training_size:
@@ -242,14 +494,21 @@ def configure_pipeline(p, opt):
     else:
       dataset = constants.TESTING_DATASET
     count += 1
-    paths_and_labels.append((dataset, study_uid_to_image_path[k], v))
+    # All images of a study go to the same dataset.
+    for path in study_uid_to_image_paths[k]:
+      paths_and_labels.append((dataset, path, v))
 
   # Shuffle the input
   random.shuffle(paths_and_labels)
   parts = (
       p
       | 'Download Labels' >> beam.Create(paths_and_labels)
-      | 'Preprocess Image' >> beam.ParDo(PreprocessImage())
+      | 'Batch Images' >> beam.BatchElements(
+          min_batch_size=opt.min_batch_size,
+          max_batch_size=opt.max_batch_size)
+      | 'Preprocess Image' >> beam.ParDo(
+          PreprocessImage(opt.bottleneck_cache_path,
+                          opt.tfhub_cache_dir))
       | 'Split into Training-Validation-Testing' >> beam.Partition(
           _partition_fn, 3))
 
@@ -300,6 +559,33 @@ def default_args(argv):
       '--output_path',
       required=True,
       help='Output directory to write results TFRecords to.')
+  parser.add_argument(
+      '--image_index_path',
+      help='Local or GCS path of a JSON index mapping study UIDs to the images '
+      'in --input_path. It is built on the first run and reused afterwards, '
+      'unless studies were added to or removed from --input_path. If not set, '
+      'the images are listed on every run.')
+  parser.add_argument(
+      '--rebuild_image_index',
+      default=False,
+      action='store_true',
+      help='List the images again even if --image_index_path exists, e.g. '
+      'after images were added to existing studies in --input_path.')
+  parser.add_argument(
+      '--listing_threads',
+      type=int,
+      default=16,
+      help='Number of study directories to list in parallel.')
+  parser.add_argument(
+      '--bottleneck_cache_path',
+      help='Directory to cache bottlenecks in, so that they are only '
+      'calculated once per image across runs. Defaults to <output_path>'
+      '_bottleneck_cache. Pass an empty string to disable the cache.')
+  parser.add_argument(
+      '--tfhub_cache_dir',
+      help='Local or GCS directory to cache the TF Hub module in. With a GCS '
+      'directory the module is downloaded once and shared by all workers, '
+      'instead of being downloaded by each worker process.')
   parser.add_argument(
       '--temp_location',
       required=True,
@@ -322,6 +608,24 @@ def default_args(argv):
       type=int,
       default=10,
       help='What percentage of images to use as a validation set.')
+  parser.add_argument(
+      '--split_at_read_time',
+      default=False,
+      action='store_true',
+      help='Write all bottlenecks into the same TFRecords instead of '
+      'splitting them into training/validation/testing here. The split is then '
+      'done by model.py, using its own --testing_percentage and '
+      '--validation_percentage.')
+  parser.add_argument(
+      '--min_batch_size',
+      type=int,
+      default=1,
+      help='Minimum number of images to calculate bottlenecks for at once.')
+  parser.add_argument(
+      '--max_batch_size',
+      type=int,
+      default=32,
+      help='Maximum number of images to calculate bottlenecks for at once.')
 
   parser.add_argument('--cloud', default=True, action='store_true')
   parser.add_argument(
@@ -331,6 +635,11 @@ def default_args(argv):
 
   parsed_args, _ = parser.parse_known_args(argv)
 
+  if parsed_args.bottleneck_cache_path is None:
+    # The cache must not be inside output_path, which only holds TFRecords.
+    parsed_args.bottleneck_cache_path = (
+        parsed_args.output_path.rstrip('/') + '_bottleneck_cache')
+
   if parsed_args.cloud:
     # Flags which need to be set for cloud runs.
     default_values = {
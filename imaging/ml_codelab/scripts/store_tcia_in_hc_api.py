@@ -28,6 +28,17 @@ https://wiki.cancerimagingarchive.net/display/Public/TCIA+Programmatic+Interface
 This script will use application default credentials when invoking Healthcare
 API.
 
+Instances are downloaded and uploaded concurrently, by separate pools of worker
+threads that each reuse a keep-alive connection. The number of concurrent
+requests to TCIA and to Healthcare API can be set with --tcia_concurrency and
+--upload_concurrency. Multiple instances are uploaded in a single STOW-RS
+request, up to --max_batch_bytes.
+
+Failed downloads and uploads are retried with exponential backoff. The imported
+series are recorded in a manifest file (--manifest_path), and are skipped when
+the script is run again, so an interrupted import can be resumed by rerunning
+the same command.
+
 Example usage:
 TCIA_API_KEY=...
 PROJECT_ID=...
@@ -46,15 +57,19 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
-from email import encoders
-from email.mime.application import MIMEApplication
-from email.mime.multipart import MIMEMultipart
+import collections
+import itertools
 import json
 import logging
-import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import Queue
+import random
+import scripts.inference.dicomweb as dicomweb
 import scripts.tcia_utils as tcia_utils
-import signal
 import sys
+import threading
+import time
 import httplib2
 from oauth2client.client import GoogleCredentials
 
@@ -66,7 +81,279 @@ logger.setLevel(logging.INFO)
 FLAGS = None
 
 _TCIA_BASE_PATH = "https://services.cancerimagingarchive.net/services/v3/TCIA/query"
-_CREDENTIALS = GoogleCredentials.get_application_default()
+_HEALTHCARE_API_URL_PREFIX = "https://healthcare.googleapis.com/v1alpha"
+
+# DICOM JSON tags of the STOW-RS response.
+_FAILED_SOP_SEQUENCE_TAG = "00081198"
+_REFERENCED_SOP_INSTANCE_UID_TAG = "00081155"
+_FAILURE_REASON_TAG = "00081197"
+_VALUE_TYPE = "Value"
+
+# Failure reason of instances that are already stored.
+_DUPLICATE_SOP_INSTANCE_REASON = 0x0111
+
+# HTTP client of the current worker thread for TCIA requests. Each
+# httplib2.Http keeps its connections alive, so a worker reuses them for all of
+# its requests.
+_thread_local = threading.local()
+
+
+def _GetTCIAHttp():
+  # type: () -> httplib2.Http
+  """Returns the HTTP client used for TCIA requests by this thread."""
+  if not hasattr(_thread_local, "tcia_http"):
+    _thread_local.tcia_http = httplib2.Http(timeout=60)  # default is 5 seconds.
+  return _thread_local.tcia_http
+
+
+class _Progress(object):
+  """Logs the number of imported instances and the throughput."""
+
+  def __init__(self, total, report_every):
+    self._total = total
+    self._report_every = report_every
+    self._start = time.time()
+    self._count = 0
+    self._bytes = 0
+
+  def Update(self, num_instances, num_bytes):
+    # type: (int, int) -> None
+    previous_count = self._count
+    self._count += num_instances
+    self._bytes += num_bytes
+    if (self._report_every and self._count // self._report_every >
+        previous_count // self._report_every):
+      self.Report()
+
+  def Report(self):
+    # type: () -> None
+    elapsed = max(time.time() - self._start, 1e-6)
+    logger.info(
+        "Imported [%s/%s] instances so far (%.2f instances/sec, "
+        "%.2f MB/sec)...", self._count, self._total, self._count / elapsed,
+        self._bytes / elapsed / 2**20)
+
+
+class _Manifest(object):
+  """JSON-lines file recording the state of each imported series.
+
+  A line is appended, and flushed, as soon as a series is imported or fails
+  permanently, so an interrupted import can be resumed without downloading the
+  series that were already imported. Later lines override earlier ones.
+  """
+
+  def __init__(self, path):
+    self._path = path
+    self._states = {}
+    if os.path.exists(path):
+      with open(path) as f:
+        for line in f:
+          try:
+            record = json.loads(line)
+          except ValueError:
+            # The last line may be truncated if the import was killed.
+            continue
+          self._states[record["series_uid"]] = record["state"]
+    self._file = open(path, "a")
+
+  def IsDone(self, series_uid):
+    # type: (str) -> bool
+    return self._states.get(series_uid) == "done"
+
+  def Record(self, series_uid, state, **fields):
+    # type: (str, str, ...) -> None
+    """Records the state ("done" or "failed") of the series."""
+    self._states[series_uid] = state
+    fields.update(series_uid=series_uid, state=state, time=time.time())
+    self._file.write(json.dumps(fields) + "\n")
+    self._file.flush()
+
+  def Close(self):
+    # type: () -> None
+    self._file.close()
+
+
+class _ImportPipeline(object):
+  """Downloads instances and uploads them in batches.
+
+  Downloads and uploads run in separate thread pools, so the number of
+  concurrent requests made to each service is limited separately. Downloaded
+  instances are uploaded together, in batches of up to max_batch_bytes, or as
+  soon as no other download is in progress. At most max_pending instances are
+  downloaded but not yet uploaded at any time, which bounds the memory used for
+  instances waiting to be uploaded.
+
+  Failed downloads and uploads are retried, after an exponential backoff. Only
+  the failed step is retried: an instance that failed to be uploaded is not
+  downloaded again.
+  """
+
+  def __init__(self, download_fn, upload_fn, tcia_concurrency,
+               upload_concurrency, max_pending, max_batch_bytes,
+               max_attempts=1, initial_backoff_secs=1.0):
+    """Creates the pipeline.
+
+    Args:
+      download_fn: Function that downloads the instance of a series, given its
+        UID, as a (SOP Instance UID, DICOM bytes) tuple.
+      upload_fn: Function that uploads a list of (SOP Instance UID, DICOM
+        bytes) tuples, and returns the (SOP Instance UID, reason) tuples of the
+        instances that failed to be stored.
+      tcia_concurrency: Max number of concurrent downloads.
+      upload_concurrency: Max number of concurrent uploads.
+      max_pending: Max number of instances downloaded but not yet uploaded.
+      max_batch_bytes: Max total size of the instances of a batch. Instances
+        are uploaded one by one if 0.
+      max_attempts: Max number of attempts to download, and to upload, each
+        instance.
+      initial_backoff_secs: Delay before the first retry, doubled after each
+        retry.
+    """
+    self._download_fn = download_fn
+    self._upload_fn = upload_fn
+    self._tcia_concurrency = tcia_concurrency
+    self._upload_concurrency = upload_concurrency
+    self._max_pending = max_pending
+    self._max_batch_bytes = max_batch_bytes
+    self._max_attempts = max_attempts
+    self._initial_backoff_secs = initial_backoff_secs
+    # Workers report results to the main thread through this queue, as
+    # ("downloaded"|"download_failed"|"uploaded", value) tuples.
+    self._events = Queue.Queue()
+
+  def _Backoff(self, attempt):
+    # type: (int) -> float
+    """Returns the delay before the given attempt (the first one is 0)."""
+    if attempt == 0:
+      return 0
+    delay = self._initial_backoff_secs * 2**(attempt - 1)
+    return delay * random.uniform(0.5, 1.5)
+
+  def _Download(self, series_uid, delay):
+    time.sleep(delay)
+    try:
+      sop_instance_uid, inst = self._download_fn(series_uid)
+      self._events.put(("downloaded", (series_uid, sop_instance_uid, inst)))
+    except Exception as e:  # pylint: disable=broad-except
+      self._events.put(("download_failed", (series_uid, repr(e))))
+
+  def _Upload(self, batch, delay):
+    """Uploads (series UID, SOP Instance UID, DICOM bytes) tuples."""
+    time.sleep(delay)
+    try:
+      failed = dict(self._upload_fn([(uid, inst) for _, uid, inst in batch]))
+    except Exception as e:  # pylint: disable=broad-except
+      failed = {uid: repr(e) for _, uid, _ in batch}
+    self._events.put(("uploaded", (batch, failed)))
+
+  def _NextEvent(self):
+    # Wait with a timeout, otherwise KeyboardInterrupt is not delivered.
+    while True:
+      try:
+        return self._events.get(timeout=1)
+      except Queue.Empty:
+        pass
+
+  def Run(self, series_uids, progress, manifest):
+    # type: (List[str], _Progress, _Manifest) -> Dict[str, str]
+    """Imports the instances of the given series.
+
+    Args:
+      series_uids: UIDs of the series to import.
+      progress: Progress of the import.
+      manifest: Manifest recording the series that were imported, or failed.
+
+    Returns:
+      Map of series UID to error, for the series that failed to be imported
+      after max_attempts.
+    """
+    tcia_pool = ThreadPool(processes=self._tcia_concurrency)
+    upload_pool = ThreadPool(processes=self._upload_concurrency)
+
+    series_uids = iter(series_uids)
+    download_attempts = collections.Counter()
+    upload_attempts = collections.Counter()
+    failures = {}
+    pending = 0
+    downloading = 0
+    batch = []
+    batch_bytes = 0
+
+    def _StartDownload(series_uid):
+      tcia_pool.apply_async(self._Download,
+                            (series_uid,
+                             self._Backoff(download_attempts[series_uid])))
+      download_attempts[series_uid] += 1
+
+    def _Failed(series_uid, error):
+      failures[series_uid] = error
+      manifest.Record(series_uid, "failed", error=error)
+      logger.warning("Failed to import series %s: %s", series_uid, error)
+
+    try:
+      for series_uid in itertools.islice(series_uids, self._max_pending):
+        _StartDownload(series_uid)
+        pending += 1
+        downloading += 1
+      while pending:
+        event, value = self._NextEvent()
+        completed = 0
+        if event == "download_failed":
+          series_uid, error = value
+          if download_attempts[series_uid] < self._max_attempts:
+            _StartDownload(series_uid)
+          else:
+            downloading -= 1
+            completed += 1
+            _Failed(series_uid, error)
+        elif event == "downloaded":
+          downloading -= 1
+          inst = value[2]
+          if batch and batch_bytes + len(inst) > self._max_batch_bytes:
+            upload_pool.apply_async(self._Upload, (batch, 0))
+            batch, batch_bytes = [], 0
+          batch.append(value)
+          batch_bytes += len(inst)
+          upload_attempts[value[0]] += 1
+        else:
+          uploaded, failed = value
+          num_done = 0
+          num_bytes = 0
+          for item in uploaded:
+            series_uid, sop_instance_uid, inst = item
+            if sop_instance_uid not in failed:
+              completed += 1
+              num_done += 1
+              num_bytes += len(inst)
+              manifest.Record(
+                  series_uid, "done", sop_instance_uid=sop_instance_uid)
+            elif upload_attempts[series_uid] < self._max_attempts:
+              upload_pool.apply_async(
+                  self._Upload,
+                  ([item], self._Backoff(upload_attempts[series_uid])))
+              upload_attempts[series_uid] += 1
+            else:
+              completed += 1
+              _Failed(series_uid, failed[sop_instance_uid])
+          progress.Update(num_done, num_bytes)
+        # Nothing else is going to be downloaded before an upload completes.
+        if batch and (not downloading or batch_bytes >= self._max_batch_bytes):
+          upload_pool.apply_async(self._Upload, (batch, 0))
+          batch, batch_bytes = [], 0
+        pending -= completed
+        for series_uid in itertools.islice(series_uids, completed):
+          _StartDownload(series_uid)
+          pending += 1
+          downloading += 1
+    except KeyboardInterrupt:
+      logger.error("Received keyboard interrupt - quitting...")
+      raise
+    finally:
+      tcia_pool.terminate()
+      upload_pool.terminate()
+      tcia_pool.join()
+      upload_pool.join()
+    return failures
 
 
 def main():
@@ -74,43 +361,59 @@ def main():
   study_uid_to_series_uid = tcia_utils.GetStudyUIDToSeriesUIDMap(
       has_study_uid=FLAGS.has_study_uid)
 
-  # Register KeyboardInterrupt handler
-  original_sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
-  pool = multiprocessing.Pool(processes=FLAGS.max_concurrency)
-  signal.signal(signal.SIGINT, original_sigint_handler)
-
-  total_instances_count = len(study_uid_to_series_uid)
-  logger.info("There are %s instances to upload...", total_instances_count)
+  manifest_path = FLAGS.manifest_path or "tcia_import_%s_%s_%s.jsonl" % (
+      FLAGS.project_id, FLAGS.dataset_id, FLAGS.dicom_store_id)
+  manifest = _Manifest(manifest_path)
+  series_uids = [
+      series_uid for series_uid in study_uid_to_series_uid.values()
+      if not manifest.IsDone(series_uid)
+  ]
+  logger.info("There are %s instances to upload, skipping %s already "
+              "uploaded according to %s...", len(series_uids),
+              len(study_uid_to_series_uid) - len(series_uids), manifest_path)
+  dicomweb_client = dicomweb.DicomWebClient(
+      GoogleCredentials.get_application_default(), timeout=60)
+  studies_url = (
+      "%s/projects/%s/locations/%s/datasets/%s/dicomStores/%s/dicomWeb/studies"
+      % (_HEALTHCARE_API_URL_PREFIX, FLAGS.project_id, FLAGS.location,
+         FLAGS.dataset_id, FLAGS.dicom_store_id))
+  progress = _Progress(len(series_uids), FLAGS.report_every)
+  pipeline = _ImportPipeline(
+      _DownloadInstanceFromTCIA,
+      lambda instances: _UploadInstancesToHealthcareAPI(
+          dicomweb_client, studies_url, instances),
+      FLAGS.tcia_concurrency or FLAGS.max_concurrency,
+      FLAGS.upload_concurrency or FLAGS.max_concurrency,
+      FLAGS.max_pending_instances, FLAGS.max_batch_bytes, FLAGS.max_attempts,
+      FLAGS.initial_backoff_secs)
   try:
-    for idx, _ in enumerate(
-        pool.imap_unordered(_DownloadInstanceFromTCIA,
-                            study_uid_to_series_uid.values()), 1):
-      # Provide an update every 100 instances uploaded.
-      if idx % 100 == 0:
-        logger.info("Imported [%s/%s] instances so far...", idx,
-                    total_instances_count)
-  except KeyboardInterrupt:
-    logger.error("Received keyboard interrupt - quitting...")
-    pool.terminate()
-    pool.join()
-    raise
-  except Exception:
-    pool.terminate()
-    pool.join()
-    raise
+    failures = pipeline.Run(series_uids, progress, manifest)
   finally:
-    pool.close()
-    pool.join()
+    manifest.Close()
+  progress.Report()
+  if failures:
+    logger.error("Failed to upload %s instances, rerun to retry them:",
+                 len(failures))
+    for series_uid, error in sorted(failures.items()):
+      logger.error("  Series %s: %s", series_uid, error)
+    sys.exit(1)
   logger.info("Successfully uploaded all instances!")
 
 
 def _DownloadInstanceFromTCIA(series_instance_uid):
-  # type: (str) -> None
-  """Downloads TCIA CBIS-DDSM an stores it in the Cloud Healthcare API."""
+  # type: (str) -> Tuple[str, str]
+  """Downloads an instance of TCIA CBIS-DDSM.
+
+  Args:
+    series_instance_uid: UID of the series, which has a single instance.
+
+  Returns:
+    (SOP Instance UID, DICOM bytes) tuple of the instance.
+  """
   sop_instance_path = (
       "%s/getSOPInstanceUIDs?SeriesInstanceUID=%s&api_key=%s" %
       (_TCIA_BASE_PATH, series_instance_uid, FLAGS.tcia_api_key))
-  http = httplib2.Http(timeout=60)  # default is 5 seconds.
+  http = _GetTCIAHttp()
   resp, content = http.request(sop_instance_path, method="GET")
   assert resp.status == 200, (
       "Failed getting instance UID for series " + series_instance_uid)
@@ -127,37 +430,79 @@ def _DownloadInstanceFromTCIA(series_instance_uid):
   resp, content = http.request(image_path, method="GET")
   assert resp.status == 200, (
       "Failed retrieving image with instance UID: " + sop_instance_uid)
-  _UploadInstanceToHealthcareAPI(sop_instance_uid, content)
-
-
-def _UploadInstanceToHealthcareAPI(sop_instance_uid, inst):
-  # type: (str, str) -> None
-  """Uploads instances in Healthcare API."""
-  http = httplib2.Http(timeout=60)
-  http = _CREDENTIALS.authorize(http)
-
-  related = MIMEMultipart("related", boundary="boundary")
-  setattr(related, "_write_headers", lambda self: None)
-
-  mime_attach = MIMEApplication(inst, "dicom", _encoder=encoders.encode_noop)
-  related.attach(mime_attach)
-
-  multipart_boundary = related.get_boundary()
-  headers = {}
-  headers["content-type"] = (
-      'multipart/related; type="application/dicom"; boundary="%s"'
-  ) % multipart_boundary
-  body = related.as_string()
-  path = "https://healthcare.googleapis.com/v1alpha/projects/{}/locations/{}/datasets/{}/dicomStores/{}/dicomWeb/studies".format(
-      FLAGS.project_id, FLAGS.location, FLAGS.dataset_id,
-      FLAGS.dicom_store_id)
-  resp, content = http.request(path, method="POST", headers=headers, body=body)
-  if resp.status == 409:
-    logger.debug("Instance with SOP Instance UID already exists: %s", sop_instance_uid)
-    return
-  assert resp.status == 200, (
-      "Failed to store instance %s, reason: %s, response: %s" %
-      (sop_instance_uid, resp.reason, content))
+  return sop_instance_uid, content
+
+
+def _GetFailedInstances(content):
+  # type: (str) -> Optional[Dict[str, int]]
+  """Returns the failure reason of each failed instance of a STOW-RS response.
+
+  Args:
+    content: Body of the STOW-RS response, in DICOM JSON format.
+
+  Returns:
+    Map of SOP Instance UID to failure reason, or None if the response could
+    not be parsed.
+  """
+  try:
+    response = json.loads(content)
+    failed = {}
+    for item in response.get(_FAILED_SOP_SEQUENCE_TAG, {}).get(
+        _VALUE_TYPE, []):
+      sop_instance_uid = item[_REFERENCED_SOP_INSTANCE_UID_TAG][_VALUE_TYPE][0]
+      failed[sop_instance_uid] = item.get(_FAILURE_REASON_TAG, {}).get(
+          _VALUE_TYPE, [None])[0]
+    return failed
+  except (ValueError, AttributeError, KeyError, IndexError, TypeError):
+    return None
+
+
+def _UploadInstancesToHealthcareAPI(http, studies_url, instances):
+  # type: (dicomweb.DicomWebClient, str, List[Tuple[str, str]]) -> List[Tuple[str, str]]
+  """Uploads instances in Healthcare API, in a single STOW-RS request.
+
+  Instances that are already stored are skipped.
+
+  Args:
+    http: DICOMweb client (or httplib2.Http) to use for the request.
+    studies_url: URL of the studies of the DICOM store.
+    instances: (SOP Instance UID, DICOM bytes) tuples of the instances.
+
+  Returns:
+    (SOP Instance UID, reason) tuples of the instances that failed to be
+    stored.
+  """
+  body = dicomweb.MultipartRelatedBody([inst for _, inst in instances])
+  headers = {
+      "content-type": body.content_type,
+      "accept": "application/dicom+json",
+  }
+  resp, content = http.request(
+      studies_url, method="POST", headers=headers, body=body)
+  if resp.status == 200:
+    return []
+  assert resp.status in (202, 409), (
+      "Failed to store instances %s, reason: %s, response: %s" %
+      ([uid for uid, _ in instances], resp.reason, content))
+
+  failed = _GetFailedInstances(content)
+  if failed is None or (not failed and resp.status == 409):
+    # All instances failed, assume they are already stored if there is one.
+    # Without a readable response, it is unknown which instances were stored
+    # after a 202, so they are all reported as failed to be retried.
+    if resp.status == 409 and len(instances) == 1:
+      failed = {instances[0][0]: _DUPLICATE_SOP_INSTANCE_REASON}
+    else:
+      return [(uid, "HTTP %d: %s" % (resp.status, content))
+              for uid, _ in instances]
+  errors = []
+  for sop_instance_uid, reason in failed.iteritems():
+    if reason == _DUPLICATE_SOP_INSTANCE_REASON:
+      logger.debug("Instance with SOP Instance UID already exists: %s",
+                   sop_instance_uid)
+    else:
+      errors.append((sop_instance_uid, "Failure reason %s" % reason))
+  return errors
 
 
 if __name__ == "__main__":
@@ -188,5 +533,51 @@ if __name__ == "__main__":
 
   parser.add_argument(
       "--max_concurrency", type=int, default=10, help="Max concurrency.")
+  parser.add_argument(
+      "--tcia_concurrency",
+      type=int,
+      default=None,
+      help="Max concurrent downloads from TCIA. Defaults to --max_concurrency.")
+  parser.add_argument(
+      "--upload_concurrency",
+      type=int,
+      default=None,
+      help="Max concurrent uploads to Cloud Healthcare API. Defaults to "
+      "--max_concurrency.")
+  parser.add_argument(
+      "--max_pending_instances",
+      type=int,
+      default=20,
+      help="Max number of instances downloaded or being downloaded, but not "
+      "yet uploaded. Bounds memory use.")
+  parser.add_argument(
+      "--max_batch_bytes",
+      type=int,
+      default=32 * 2**20,
+      help="Max total size in bytes of the instances uploaded in a single "
+      "STOW-RS request. Instances are uploaded one by one if 0.")
+  parser.add_argument(
+      "--manifest_path",
+      type=str,
+      default=None,
+      help="JSON-lines file recording the imported series, used to resume an "
+      "interrupted import. Defaults to "
+      "tcia_import_<project_id>_<dataset_id>_<dicom_store_id>.jsonl.")
+  parser.add_argument(
+      "--max_attempts",
+      type=int,
+      default=5,
+      help="Max number of attempts to download, and to upload, an instance.")
+  parser.add_argument(
+      "--initial_backoff_secs",
+      type=float,
+      default=1.0,
+      help="Delay before retrying a failed download or upload, doubled after "
+      "each retry.")
+  parser.add_argument(
+      "--report_every",
+      type=int,
+      default=100,
+      help="Log progress and throughput every this many instances.")
   FLAGS, unparsed = parser.parse_known_args()
   main()
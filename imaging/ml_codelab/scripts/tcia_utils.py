@@ -14,7 +14,13 @@
 """Utility functions for dealing with TCIA data."""
 
 import csv
+import json
+import logging
+from multiprocessing.pool import ThreadPool
+import os
 import StringIO
+import tempfile
+import threading
 import httplib2
 
 # Labels files that contain breast density labels and UIDs.
@@ -24,6 +30,9 @@ _LABEL_PATHS = [
     "https://wiki.cancerimagingarchive.net/download/attachments/22516629/mass_case_description_test_set.csv",
     "https://wiki.cancerimagingarchive.net/download/attachments/22516629/calc_case_description_test_set.csv",
 ]
+# Directory where label files are cached by default.
+_DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "tcia_labels")
 _BREAST_DENSITY_COLUMN = {"breast_density", "breast density"}
 _IMAGE_FILE_PATH_COLUMN = {"image file path"}
 
@@ -43,24 +52,118 @@ _BLACKLISTED_STUDY_UIDS = {
 }
 
 
-def _GetStudyUIDMaps(has_study_uid=None):
-  """Returns a map of Study UID to Series UID and Study UID to label.
+# Maps parsed from the label files, per cache directory, shared by all callers
+# in this process.
+_study_uid_maps = {}
+_study_uid_maps_lock = threading.Lock()
+
+
+def _DownloadLabelFile(path, cache_dir):
+  """Returns the content of a label file, downloading it only if it changed.
+
+  The file and its ETag/Last-Modified headers are stored in cache_dir, and are
+  used to issue a conditional request. If the file was not modified, or if it
+  cannot be downloaded (connection error or any status other than 200 and
+  304), the cached copy is used.
 
   Args:
-   has_study_uid: If set, it only returns instances that match this Study UID.
+   path: URL of the label file.
+   cache_dir: Directory to cache the label file in.
+
+  Returns:
+   The content of the label file.
+
+  Raises:
+   IOError: If the file cannot be downloaded and is not cached.
+  """
+  cached_path = os.path.join(cache_dir, path.rsplit("/", 1)[1])
+  metadata_path = cached_path + ".metadata.json"
+  is_cached = os.path.exists(cached_path)
+  headers = {}
+  if is_cached and os.path.exists(metadata_path):
+    with open(metadata_path) as f:
+      metadata = json.load(f)
+    if metadata.get("etag"):
+      headers["if-none-match"] = metadata["etag"]
+    if metadata.get("last-modified"):
+      headers["if-modified-since"] = metadata["last-modified"]
+
+  http = httplib2.Http(timeout=60, disable_ssl_certificate_validation=True)
+  try:
+    resp, content = http.request(path, method="GET", headers=headers)
+  except (httplib2.HttpLib2Error, IOError) as e:
+    if not is_cached:
+      raise
+    logging.warning("Failed to download %s, using cached copy: %s", path, e)
+    resp, content = None, None
+
+  if resp is not None and resp.status not in (200, 304):
+    if not is_cached:
+      raise IOError("Failed to download label file %s: HTTP %s %s" %
+                    (path, resp.status, resp.reason))
+    logging.warning("Failed to download %s (HTTP %s), using cached copy", path,
+                    resp.status)
+    resp = None
+
+  if resp is None or resp.status == 304:
+    with open(cached_path, "rb") as f:
+      return f.read()
+
+  # The content is written before its metadata, so that the metadata never
+  # validates a stale copy.
+  _WriteFileAtomically(cached_path, content)
+  _WriteFileAtomically(
+      metadata_path,
+      json.dumps({
+          "etag": resp.get("etag"),
+          "last-modified": resp.get("last-modified")
+      }))
+  return content
+
+
+def _WriteFileAtomically(path, content):
+  """Writes a file under a temporary name, then renames it into place.
+
+  Args:
+   path: Path of the file.
+   content: Content of the file.
+  """
+  fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+  try:
+    with os.fdopen(fd, "wb") as f:
+      f.write(content)
+    os.rename(temp_path, path)
+  finally:
+    if os.path.exists(temp_path):
+      os.remove(temp_path)
+
+
+def _ParseLabelFiles(cache_dir):
+  """Downloads all label files concurrently and parses them.
+
+  Args:
+   cache_dir: Directory to cache the label files in.
 
   Returns:
    A Dict of Study UID -> Series UID.
    A Dict of Study UID -> label.
   """
+  # Created before the downloads start, so that their threads do not race to
+  # create it.
+  if not os.path.exists(cache_dir):
+    os.makedirs(cache_dir)
+  pool = ThreadPool(len(_LABEL_PATHS))
+  try:
+    contents = pool.map(lambda path: _DownloadLabelFile(path, cache_dir),
+                        _LABEL_PATHS)
+  finally:
+    pool.close()
+    pool.join()
 
   # Download UIDs for breast density 2 and 3.
-  http = httplib2.Http(timeout=60, disable_ssl_certificate_validation=True)
   study_uid_to_series_uid = {}
   study_uid_to_label = {}
-  for path in _LABEL_PATHS:
-    resp, content = http.request(path, method="GET")
-    assert resp.status == 200, "Failed to download label files from: " + path
+  for content in contents:
     r = csv.reader(StringIO.StringIO(content), delimiter=",")
     header = r.next()
     breast_density_column = -1
@@ -80,13 +183,43 @@ def _GetStudyUIDMaps(has_study_uid=None):
       study_instance_uid, series_instance_uid = dicom_uids[1], dicom_uids[2]
       if study_instance_uid in _BLACKLISTED_STUDY_UIDS:
         continue
-      if has_study_uid and has_study_uid != study_instance_uid:
-        continue
       study_uid_to_series_uid[study_instance_uid] = series_instance_uid
       study_uid_to_label[study_instance_uid] = density
   return study_uid_to_series_uid, study_uid_to_label
 
 
+def GetStudyUIDMaps(has_study_uid=None, cache_dir=None):
+  """Returns a map of Study UID to Series UID and Study UID to label.
+
+  The label files are downloaded and parsed only once per process, so callers
+  needing both maps should prefer this over calling GetStudyUIDToSeriesUIDMap
+  and GetStudyUIDToLabelMap separately.
+
+  Args:
+   has_study_uid: If set, it only returns instances that match this Study UID.
+   cache_dir: Directory to cache the label files in. Defaults to
+     ~/.cache/tcia_labels.
+
+  Returns:
+   A Dict of Study UID -> Series UID.
+   A Dict of Study UID -> label.
+  """
+  cache_dir = cache_dir or _DEFAULT_CACHE_DIR
+  with _study_uid_maps_lock:
+    if cache_dir not in _study_uid_maps:
+      _study_uid_maps[cache_dir] = _ParseLabelFiles(cache_dir)
+    study_uid_to_series_uid, study_uid_to_label = _study_uid_maps[cache_dir]
+
+  def _Filter(study_uid_map):
+    return {
+        k: v
+        for k, v in study_uid_map.iteritems()
+        if not has_study_uid or has_study_uid == k
+    }
+
+  return _Filter(study_uid_to_series_uid), _Filter(study_uid_to_label)
+
+
 def GetStudyUIDToSeriesUIDMap(has_study_uid=None):
   """Returns a map of Study UID to Series UID.
 
@@ -96,7 +229,7 @@ def GetStudyUIDToSeriesUIDMap(has_study_uid=None):
   Returns:
    A Dict of Study UID -> Series UID.
   """
-  return _GetStudyUIDMaps(has_study_uid)[0]
+  return GetStudyUIDMaps(has_study_uid)[0]
 
 
 def GetStudyUIDToLabelMap(has_study_uid=None):
@@ -108,4 +241,4 @@ def GetStudyUIDToLabelMap(has_study_uid=None):
   Returns:
    A Dict of Study UID -> label.
   """
-  return _GetStudyUIDMaps(has_study_uid)[1]
+  return GetStudyUIDMaps(has_study_uid)[1]
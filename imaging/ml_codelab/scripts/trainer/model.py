@@ -29,6 +29,11 @@ This script roughly does the following:
    training, validation or test dataset. The percentage of each can be specified
    by using the --validation_percentage and --testing_percentage flags.
 
+   If the TFRecords were already split by preprocess.py, that split is used
+   instead. Otherwise (preprocess.py --split_at_read_time), records are split
+   by a hash of their study UID, so the split can be changed without
+   preprocessing the images again.
+
 2) Add dense layer and softmax layer for classification.
 
    Add a dense and a softmax layer that classify mammography images as
@@ -81,13 +86,52 @@ FLAGS = None
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 
 # Size of bottleneck vector for Inception V3.
-INCEPTION_V3_BOTTLENECK_SIZE = 2048
+INCEPTION_V3_BOTTLENECK_SIZE = constants.BOTTLENECK_SIZE
 
 # File to store model checkpoint containing just the weights and biases of
 # dense layer.
 _CHECKPOINT_FILE = '/tmp/model.ckpt'
 
 
+def _get_dataset(example):
+  # type: tensorflow.train.Example -> str
+  """Returns the dataset a parsed bottleneck record belongs to."""
+  if 'dataset' in example.features.feature:
+    return example.features.feature['dataset'].bytes_list.value[0]
+  return ml_utils.get_dataset_split(
+      example.features.feature['study_uid'].bytes_list.value[0],
+      FLAGS.validation_percentage, FLAGS.testing_percentage)
+
+
+def _get_bottleneck_files(bottleneck_dir):
+  # type: str -> (bool, Dict[str, List[str]])
+  """Selects the bottleneck TFRecords to read for each dataset.
+
+  If bottleneck_dir holds records written by preprocess.py
+  --split_at_read_time, only those are read, and every dataset is read from
+  all of them. Otherwise each dataset is read from its own records.
+
+  Args:
+    bottleneck_dir: Directory containing the bottleneck TFRecords.
+
+  Returns:
+    (split_at_read_time, dataset_to_files) tuple.
+  """
+  unsplit_bottleneck_files = file_io.get_matching_files(
+      os.path.join(bottleneck_dir, constants.UNSPLIT_DATASET + '*'))
+  dataset_to_files = {}
+  for dataset_name in [
+      constants.TRAINING_DATASET, constants.VALIDATION_DATASET,
+      constants.TESTING_DATASET
+  ]:
+    if unsplit_bottleneck_files:
+      dataset_to_files[dataset_name] = unsplit_bottleneck_files
+    else:
+      dataset_to_files[dataset_name] = file_io.get_matching_files(
+          os.path.join(bottleneck_dir, dataset_name + '*'))
+  return bool(unsplit_bottleneck_files), dataset_to_files
+
+
 def _get_image_label_info(bottleneck_dir):
   # type: str -> (int, List[str])
   """Calculates the number of images and unique labels in dataset.
@@ -103,16 +147,17 @@ def _get_image_label_info(bottleneck_dir):
   """
   labels = OrderedDict()
   dataset_to_image_count = defaultdict(int)
-  bottleneck_files = file_io.get_matching_files(
-      os.path.join(bottleneck_dir, '*'))
-  for bottleneck_file in bottleneck_files:
+  _, dataset_to_files = _get_bottleneck_files(bottleneck_dir)
+  bottleneck_files = set()
+  for files in dataset_to_files.values():
+    bottleneck_files.update(files)
+  for bottleneck_file in sorted(bottleneck_files):
     for it in tf.python_io.tf_record_iterator(bottleneck_file):
       example = tf.train.Example()
       example.ParseFromString(it)
       label = example.features.feature['label'].bytes_list.value[0]
       labels[label] = True
-      dataset = example.features.feature['dataset'].bytes_list.value[0]
-      dataset_to_image_count[dataset] += 1
+      dataset_to_image_count[_get_dataset(example)] += 1
 
   label_list = []
   for key in labels:
@@ -152,19 +197,37 @@ def _get_training_validation_testing_dataset(bottleneck_dir, label_table,
     label_index = label_table.lookup(example['label'])
     return example['image_path'], label_index, example['bottleneck']
 
-  training_bottleneck_files = file_io.get_matching_files(
-      os.path.join(bottleneck_dir, constants.TRAINING_DATASET + '*'))
-  training_dataset = tf.data.TFRecordDataset(training_bottleneck_files).map(
+  split_at_read_time, dataset_to_files = _get_bottleneck_files(bottleneck_dir)
+
+  def _get_records(dataset_name):
+    """Returns a Dataset of the serialized records of a dataset."""
+    records = tf.data.TFRecordDataset(dataset_to_files[dataset_name])
+    if not split_at_read_time:
+      return records
+
+    def _in_dataset(serialized_example):
+      study_uid = tf.parse_single_example(
+          serialized_example,
+          features={'study_uid': tf.FixedLenFeature((), tf.string)
+                   })['study_uid']
+      split = tf.py_func(
+          lambda uid: ml_utils.get_dataset_split(
+              uid, FLAGS.validation_percentage, FLAGS.testing_percentage),
+          [study_uid],
+          tf.string,
+          stateful=False)
+      split.set_shape([])
+      return tf.equal(split, dataset_name)
+
+    return records.filter(_in_dataset)
+
+  training_dataset = _get_records(constants.TRAINING_DATASET).map(
       _full_tfrecord_parser).repeat().batch(FLAGS.train_batch_size)
 
-  validation_bottleneck_files = file_io.get_matching_files(
-      os.path.join(bottleneck_dir, constants.VALIDATION_DATASET + '*'))
-  validation_dataset = tf.data.TFRecordDataset(validation_bottleneck_files).map(
+  validation_dataset = _get_records(constants.VALIDATION_DATASET).map(
       _full_tfrecord_parser).repeat().batch(FLAGS.validation_batch_size)
 
-  testing_bottleneck_files = file_io.get_matching_files(
-      os.path.join(bottleneck_dir, constants.TESTING_DATASET + '*'))
-  testing_dataset = tf.data.TFRecordDataset(testing_bottleneck_files).map(
+  testing_dataset = _get_records(constants.TESTING_DATASET).map(
       _full_tfrecord_parser).batch(testing_dataset_size)
   return training_dataset, validation_dataset, testing_dataset
 
@@ -508,6 +571,22 @@ if __name__ == '__main__':
       training sets.\
       """
   )
+  parser.add_argument(
+      '--testing_percentage',
+      type=int,
+      default=10,
+      help="""\
+      What percentage of images to use as a test set. Only used if the
+      bottlenecks were not split by preprocess.py (--split_at_read_time).\
+      """)
+  parser.add_argument(
+      '--validation_percentage',
+      type=int,
+      default=10,
+      help="""\
+      What percentage of images to use as a validation set. Only used if the
+      bottlenecks were not split by preprocess.py (--split_at_read_time).\
+      """)
   parser.add_argument(
       '--print_misclassified_test_images',
       default=False,